@@ -12,6 +12,7 @@
 """
 Benchmark inference speed of Deformable DETR.
 """
+import copy
 import os
 import time
 import argparse
@@ -21,26 +22,47 @@ import torch
 from main import get_args_parser as get_main_args_parser
 from models import build_model
 from datasets import build_dataset
+from util.cache import ShapeCache
 from util.misc import nested_tensor_from_tensor_list
+from models.structures import Instances
 
 
 def get_benckmark_arg_parser():
-    parser = argparse.ArgumentParser('Benchmark inference speed of Deformable DETR.')
+    parser = argparse.ArgumentParser('Benchmark inference speed of Deformable DETR.', allow_abbrev=False)
     parser.add_argument('--num_iters', type=int, default=300, help='total iters to benchmark speed')
     parser.add_argument('--warm_iters', type=int, default=5, help='ignore first several iters that are very slow')
     parser.add_argument('--batch_size', type=int, default=1, help='batch size in inference')
     parser.add_argument('--resume', type=str, help='load the pre-trained checkpoint')
+    parser.add_argument('--input_size', type=int, nargs=2, default=None, metavar=('H', 'W'),
+                        help='benchmark on a random image of this size instead of the first image of the val set')
+    parser.add_argument('--backbone_only', action='store_true', help='only time the backbone')
+    parser.add_argument('--decoder_only', action='store_true',
+                        help='only time the decoder and the prediction heads of MOTR on an encoded frame, '
+                             'e.g. with --two_stage --num_queries k to compare the numbers of detect queries')
+    parser.add_argument('--num_tracks', type=int, default=0, help='active tracks decoded along the detect queries')
+    parser.add_argument('--frame_step', action='store_true',
+                        help='time the tracking step of MOTR per frame, on a new copy of the image every iteration '
+                             'like the frames of a video, with the tracks of the previous iteration')
+    parser.add_argument('--no_shape_cache', action='store_true',
+                        help='disable the caches of the position encodings, masks and encoder geometry, '
+                             'e.g. with --frame_step to measure what they save per frame')
     return parser
 
 
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
 @torch.no_grad()
 def measure_average_inference_time(model, inputs, num_iters=100, warm_iters=5):
+    device = inputs.tensors.device
     ts = []
     for iter_ in range(num_iters):
-        torch.cuda.synchronize()
+        synchronize(device)
         t_ = time.perf_counter()
         model(inputs)
-        torch.cuda.synchronize()
+        synchronize(device)
         t = time.perf_counter() - t_
         if iter_ >= warm_iters:
           ts.append(t)
@@ -48,25 +70,88 @@ def measure_average_inference_time(model, inputs, num_iters=100, warm_iters=5):
     return sum(ts) / len(ts)
 
 
+@torch.no_grad()
+def decoder_step(model, inputs, num_tracks):
+    """Decoding of the first encoded image of `inputs` by MOTR, with `num_tracks` tracks copied from the detect queries."""
+    encoded = model._select_encoded(model._encode_images(inputs), 0)
+    detect = model._generate_empty_tracks()
+    tracks = detect[torch.arange(num_tracks) % len(detect)]
+    tracks.obj_idxes = torch.arange(num_tracks, device=tracks.obj_idxes.device)
+    track_instances = Instances.cat([detect, tracks])
+    return lambda _: model._decode_single_image(encoded, track_instances)
+
+
+def frame_step(model, img):
+    """Tracking step of MOTR on a new copy of `img` per call, so that nothing is cached on the input tensor."""
+    state = {'track_instances': None}
+
+    def step(_):
+        track_instances = state['track_instances']
+        if track_instances is not None:
+            track_instances.remove('boxes')
+            track_instances.remove('labels')
+        res = model.inference_single_image(img.clone()[None], img.shape[1:], track_instances)
+        state['track_instances'] = res['track_instances']
+    return step
+
+
+@torch.no_grad()
+def check_backbone_equal(reference, backbone, inputs, rtol=1e-4):
+    """Asserts that the optimized backbone returns the features of the original one, up to float rounding."""
+    for (name, ref), out in zip(reference(inputs).items(), backbone(inputs).values()):
+        max_abs_err = (out.tensors - ref.tensors).abs().max()
+        max_rel_err = max_abs_err / ref.tensors.abs().max()
+        print(f'* {bool(max_rel_err < rtol)} check_backbone_equal level {name}: '
+              f'max_abs_err {max_abs_err:.2e} max_rel_err {max_rel_err:.2e}')
+        assert max_rel_err < rtol and torch.equal(out.mask, ref.mask)
+
+
+def disable_shape_caches(model):
+    for module in model.modules():
+        for value in vars(module).values():
+            if isinstance(value, ShapeCache):
+                value.maxsize = 0
+
+
 def benchmark():
     args, _ = get_benckmark_arg_parser().parse_known_args()
     main_args = get_main_args_parser().parse_args(_)
     assert args.warm_iters < args.num_iters and args.num_iters > 0 and args.warm_iters >= 0
     assert args.batch_size > 0
     assert args.resume is None or os.path.exists(args.resume)
-    dataset = build_dataset('val', main_args)
     model, _, _ = build_model(main_args)
-    model.cuda()
+    device = torch.device(main_args.device)
+    if main_args.num_threads > 0:
+        torch.set_num_threads(main_args.num_threads)
+    model.to(device)
     model.eval()
     if args.resume is not None:
         ckpt = torch.load(args.resume, map_location=lambda storage, loc: storage)
         model.load_state_dict(ckpt['model'])
-    inputs = nested_tensor_from_tensor_list([dataset.__getitem__(0)[0].cuda() for _ in range(args.batch_size)])
+    if args.input_size is not None:
+        img = torch.rand((3, ) + tuple(args.input_size))
+    else:
+        img = build_dataset('val', main_args).__getitem__(0)[0]
+    inputs = nested_tensor_from_tensor_list([img.to(device) for _ in range(args.batch_size)])
+    if main_args.fold_backbone_bn or main_args.channels_last:
+        reference = copy.deepcopy(model.backbone[0])
+        model.backbone[0].optimize_for_inference(main_args.fold_backbone_bn, main_args.channels_last)
+        check_backbone_equal(reference, model.backbone[0], inputs)
+        del reference
+    if args.no_shape_cache:
+        disable_shape_caches(model)
+    if args.frame_step:
+        assert args.batch_size == 1
+        model = frame_step(model, img.to(device))
+    elif args.backbone_only:
+        model = model.backbone
+    elif args.decoder_only:
+        model = decoder_step(model, inputs, args.num_tracks)
     t = measure_average_inference_time(model, inputs, args.num_iters, args.warm_iters)
     return 1.0 / t * args.batch_size
 
 
 if __name__ == '__main__':
     fps = benchmark()
-    print(f'Inference Speed: {fps:.1f} FPS')
+    print(f'Inference Speed: {fps:.1f} FPS ({torch.get_num_threads()} threads)')
 
@@ -9,173 +9,14 @@
 # ------------------------------------------------------------------------
 
 from __future__ import print_function
-import glob
-import math
 import os
-import os.path as osp
-import random
-import time
-from collections import OrderedDict
-import torchvision.transforms.functional as F
-import cv2
-import numpy as np
 import torch
 import argparse
-import torchvision.transforms.functional as F
-from tqdm import tqdm
 from pathlib import Path
-from PIL import Image, ImageDraw
-from models import build_model
-from util.tool import load_model
 from main import get_args_parser
-from torch.nn.functional import interpolate
-from typing import List
-import shutil
-from models.structures import Instances
+from inference import build_inference_engine, VideoReader, MOTResultWriter, ImageWriter, VideoWriter, configure_threads, \
+    load_inference_model
 
-np.random.seed(2020)
-
-COLORS_10 = [(144, 238, 144), (178, 34, 34), (221, 160, 221), (0, 255, 0), (0, 128, 0), (210, 105, 30), (220, 20, 60),
-             (192, 192, 192), (255, 228, 196), (50, 205, 50), (139, 0, 139), (100, 149, 237), (138, 43, 226),
-             (238, 130, 238),
-             (255, 0, 255), (0, 100, 0), (127, 255, 0), (255, 0, 255), (0, 0, 205), (255, 140, 0), (255, 239, 213),
-             (199, 21, 133), (124, 252, 0), (147, 112, 219), (106, 90, 205), (176, 196, 222), (65, 105, 225),
-             (173, 255, 47),
-             (255, 20, 147), (219, 112, 147), (186, 85, 211), (199, 21, 133), (148, 0, 211), (255, 99, 71),
-             (144, 238, 144),
-             (255, 255, 0), (230, 230, 250), (0, 0, 255), (128, 128, 0), (189, 183, 107), (255, 255, 224),
-             (128, 128, 128),
-             (105, 105, 105), (64, 224, 208), (205, 133, 63), (0, 128, 128), (72, 209, 204), (139, 69, 19),
-             (255, 245, 238),
-             (250, 240, 230), (152, 251, 152), (0, 255, 255), (135, 206, 235), (0, 191, 255), (176, 224, 230),
-             (0, 250, 154),
-             (245, 255, 250), (240, 230, 140), (245, 222, 179), (0, 139, 139), (143, 188, 143), (255, 0, 0),
-             (240, 128, 128),
-             (102, 205, 170), (60, 179, 113), (46, 139, 87), (165, 42, 42), (178, 34, 34), (175, 238, 238),
-             (255, 248, 220),
-             (218, 165, 32), (255, 250, 240), (253, 245, 230), (244, 164, 96), (210, 105, 30)]
-
-
-def plot_one_box(x, img, color=None, label=None, score=None, line_thickness=None):
-    # Plots one bounding box on image img
-
-    # tl = line_thickness or round(
-    #     0.002 * max(img.shape[0:2])) + 1  # line thickness
-    tl = 2
-    color = color or [random.randint(0, 255) for _ in range(3)]
-    c1, c2 = (int(x[0]), int(x[1])), (int(x[2]), int(x[3]))
-    cv2.rectangle(img, c1, c2, color, thickness=tl)
-    if label:
-        tf = max(tl - 1, 1)  # font thickness
-        t_size = cv2.getTextSize(label, 0, fontScale=tl / 3, thickness=tf)[0]
-        c2 = c1[0] + t_size[0], c1[1] - t_size[1] - 3
-        cv2.rectangle(img, c1, c2, color, -1)  # filled
-        cv2.putText(img,
-                    label, (c1[0], c1[1] - 2),
-                    0,
-                    tl / 3, [225, 255, 255],
-                    thickness=tf,
-                    lineType=cv2.LINE_AA)
-        if score is not None:
-            cv2.putText(img, score, (c1[0], c1[1] + 30), 0, tl / 3, [225, 255, 255], thickness=tf, lineType=cv2.LINE_AA)
-    return img
-
-
-def draw_bboxes(ori_img, bbox, identities=None, offset=(0, 0), cvt_color=False):
-    if cvt_color:
-        ori_img = cv2.cvtColor(np.asarray(ori_img), cv2.COLOR_RGB2BGR)
-    img = ori_img
-    for i, box in enumerate(bbox):
-        x1, y1, x2, y2 = [int(i) for i in box[:4]]
-        x1 += offset[0]
-        x2 += offset[0]
-        y1 += offset[1]
-        y2 += offset[1]
-        if len(box) > 4:
-            score = '{:.2f}'.format(box[4])
-        else:
-            score = None
-        # box text and bar
-        id = int(identities[i]) if identities is not None else 0
-        color = COLORS_10[id % len(COLORS_10)]
-        label = '{:d}'.format(id)
-        # t_size = cv2.getTextSize(label, cv2.FONT_HERSHEY_PLAIN, 2 , 2)[0]
-        img = plot_one_box([x1, y1, x2, y2], img, color, label, score=score)
-    return img
-
-
-def draw_points(img: np.ndarray, points: np.ndarray, color=(255, 255, 255)) -> np.ndarray:
-    assert len(points.shape) == 2 and points.shape[1] == 2, 'invalid points shape: {}'.format(points.shape)
-    for i, (x, y) in enumerate(points):
-        if i >= 300:
-            color = (0, 255, 0)
-        cv2.circle(img, (int(x), int(y)), 2, color=color, thickness=2)
-    return img
-
-class LoadVideo:  # for inference
-    def __init__(self, path, img_size=(1536, 800)):
-        if not os.path.isfile(path):
-            raise FileExistsError
-        
-        self.cap = cv2.VideoCapture(path)        
-        self.frame_rate = int(round(self.cap.get(cv2.CAP_PROP_FPS)))
-        self.seq_w = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        self.seq_h = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        self.vn = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-        self.width = img_size[0]
-        self.height = img_size[1]
-        self.count = 0
-
-        self.mean = [0.485, 0.456, 0.406]
-        self.std = [0.229, 0.224, 0.225]
-
-        print('Lenth of the video: {:d} frames'.format(self.vn))
-
-    def __iter__(self):
-        self.count = -1
-        return self
-
-    def __next__(self):
-        self.count += 1
-        if self.count == len(self):
-            raise StopIteration
-        # Read image
-        res, img = self.cap.read()  # BGR
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB) # RGB
-        assert img is not None, 'Failed to load frame {:d}'.format(self.count)
-
-        cur_img, ori_img = self.init_img(img)
-        return self.count, cur_img, ori_img
-
-    def init_img(self, img):
-        ori_img = img.copy()
-        self.seq_h, self.seq_w = img.shape[:2]
-        scale = self.height / min(self.seq_h, self.seq_w)
-        if max(self.seq_h, self.seq_w) * scale > self.width:
-            scale = self.width / max(self.seq_h, self.seq_w)
-        target_h = int(self.seq_h * scale)
-        target_w = int(self.seq_w * scale)
-        img = cv2.resize(img, (target_w, target_h))
-        img = F.normalize(F.to_tensor(img), self.mean, self.std)
-        img = img.unsqueeze(0)
-        return img, ori_img
-
-    def __len__(self):
-        return self.vn  # number of files
-
-class MOTR(object):
-    def update(self, dt_instances: Instances):
-        ret = []
-        for i in range(len(dt_instances)):
-            label = dt_instances.labels[i]
-            if label == 0:
-                id = dt_instances.obj_idxes[i]
-                box_with_score = np.concatenate([dt_instances.boxes[i], dt_instances.scores[i:i+1]], axis=-1)
-                ret.append(np.concatenate((box_with_score, [id + 1])).reshape(1, -1))  # +1 as MOT benchmark requires positive
-        if len(ret) > 0:
-            return np.concatenate(ret)
-        return np.empty((0, 6))
 
 class Detector(object):
     def __init__(self, args):
@@ -183,11 +24,7 @@ class Detector(object):
         self.args = args
 
         # build model and load weights
-        self.model, _, _ = build_model(args)
-        checkpoint = torch.load(args.resume, map_location='cpu')
-        self.model = load_model(self.model, args.resume)
-        self.model = self.model.cuda()
-        self.model.eval()
+        self.model = load_inference_model(args)
 
         # mkidr save_dir
         vid_name, prefix = args.input_video.split('/')[-1].split('.')
@@ -198,80 +35,20 @@ class Detector(object):
         self.txt_root = os.path.join(self.save_root, f'{vid_name}.txt')
         self.vid_root = os.path.join(self.save_root, args.input_video.split('/')[-1])
 
-        # build dataloader and tracker
-        self.dataloader = LoadVideo(args.input_video)
-        self.tr_tracker = MOTR()
-
-    @staticmethod
-    def filter_dt_by_score(dt_instances: Instances, prob_threshold: float) -> Instances:
-        keep = dt_instances.scores > prob_threshold
-        return dt_instances[keep]
-
-    @staticmethod
-    def filter_dt_by_area(dt_instances: Instances, area_threshold: float) -> Instances:
-        wh = dt_instances.boxes[:, 2:4] - dt_instances.boxes[:, 0:2]
-        areas = wh[:, 0] * wh[:, 1]
-        keep = areas > area_threshold
-        return dt_instances[keep]
-
-    @staticmethod
-    def write_results(txt_path, frame_id, bbox_xyxy, identities):
-        save_format = '{frame},{id},{x1},{y1},{w},{h},1,-1,-1,-1\n'
-        with open(txt_path, 'a') as f:
-            for xyxy, track_id in zip(bbox_xyxy, identities):
-                if track_id < 0 or track_id is None:
-                    continue
-                x1, y1, x2, y2 = xyxy
-                w, h = x2 - x1, y2 - y1
-                line = save_format.format(frame=int(frame_id), id=int(track_id), x1=x1, y1=y1, w=w, h=h)
-                f.write(line)
-
-    @staticmethod
-    def visualize_img_with_bbox(img_path, img, dt_instances: Instances, ref_pts=None, gt_boxes=None):
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-        if dt_instances.has('scores'):
-            img_show = draw_bboxes(img, np.concatenate([dt_instances.boxes, dt_instances.scores.reshape(-1, 1)], axis=-1), dt_instances.obj_idxes)
-        else:
-            img_show = draw_bboxes(img, dt_instances.boxes, dt_instances.obj_idxes)
-        if ref_pts is not None:
-            img_show = draw_points(img_show, ref_pts)
-        if gt_boxes is not None:
-            img_show = draw_bboxes(img_show, gt_boxes, identities=np.ones((len(gt_boxes), )) * -1)
-        cv2.imwrite(img_path, img_show)
-        return img_show
+        # build dataloader and engine
+        self.dataloader = VideoReader(args.input_video)
+        self.engine = build_inference_engine(args, self.model)
 
     def run(self, prob_threshold=0.7, area_threshold=100, vis=True, dump=True):
-        # save as video
-        fps = self.dataloader.frame_rate
-        videowriter = cv2.VideoWriter(self.vid_root, cv2.VideoWriter_fourcc('M','J','P','G'), fps, (self.dataloader.seq_w, self.dataloader.seq_h))
-        track_instances = None
-        fid = 0
-        for _, cur_img, ori_img in tqdm(self.dataloader):
-            if track_instances is not None:
-                track_instances.remove('boxes')
-                track_instances.remove('labels')
-
-            res = self.model.inference_single_image(cur_img.cuda().float(), (self.dataloader.seq_h, self.dataloader.seq_w), track_instances)
-            track_instances = res['track_instances']
-            dt_instances = track_instances.to(torch.device('cpu'))
-
-            # filter det instances by score.
-            dt_instances = self.filter_dt_by_score(dt_instances, prob_threshold)
-            dt_instances = self.filter_dt_by_area(dt_instances, area_threshold)
-
-            if vis:
-                vis_img_path = os.path.join(self.save_img_root, '{:06d}.jpg'.format(fid))
-                vis_img = self.visualize_img_with_bbox(vis_img_path, ori_img, dt_instances)
-                videowriter.write(vis_img)
-
-            if dump:
-                tracker_outputs = self.tr_tracker.update(dt_instances)
-                self.write_results(txt_path=self.txt_root,
-                                frame_id=(fid+1),
-                                bbox_xyxy=tracker_outputs[:, :4],
-                                identities=tracker_outputs[:, 5])
-            fid += 1
-        videowriter.release()
+        sinks = []
+        if vis:
+            # save as video
+            fps = self.dataloader.frame_rate
+            sinks.append(ImageWriter(self.save_img_root, '{:06d}.jpg'))
+            sinks.append(VideoWriter(self.vid_root, fps, (self.dataloader.seq_w, self.dataloader.seq_h)))
+        if dump:
+            sinks.append(MOTResultWriter(self.txt_root, save_npz=self.args.save_npz))
+        self.engine.run(self.dataloader, sinks, prob_threshold, area_threshold)
 
 if __name__ == '__main__':
 
@@ -280,5 +57,6 @@ if __name__ == '__main__':
     if args.output_dir:
         Path(args.output_dir).mkdir(parents=True, exist_ok=True)
 
+    configure_threads(args)
     detector = Detector(args)
     detector.run()
\ No newline at end of file
@@ -0,0 +1,52 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+
+"""
+Export the per-frame tracking step of MOTR as a TorchScript module, to be run with --traced_model.
+The exported step is specialized to the device and to the input size of --export_frame, export one
+module per resolution of the target sequences.
+"""
+import argparse
+
+import torch
+
+from main import get_args_parser as get_main_args_parser
+from models import build_model
+from models.motr_step import trace_motr_step
+from util.tool import load_model
+from inference import ImagePreprocessor
+
+
+def get_export_arg_parser():
+    parser = argparse.ArgumentParser('Export the tracking step of MOTR with TorchScript.')
+    parser.add_argument('--export_path', type=str, required=True, help='path of the exported module')
+    parser.add_argument('--export_frame', type=str, required=True,
+                        help='a frame of the target sequences containing objects, fixes the input size')
+    parser.add_argument('--num_warmup_frames', type=int, default=2,
+                        help='steps run on the frame before tracing, the state they leave is traced')
+    return parser
+
+
+@torch.no_grad()
+def export():
+    args, _ = get_export_arg_parser().parse_known_args()
+    main_args = get_main_args_parser().parse_args(_)
+    device = torch.device(main_args.device)
+    model, _, _ = build_model(main_args)
+    model = load_model(model, main_args.resume)
+    model.eval()
+    if main_args.fold_backbone_bn or main_args.channels_last:
+        model.backbone[0].optimize_for_inference(main_args.fold_backbone_bn, main_args.channels_last)
+    model.to(device)
+
+    img, ori_img = ImagePreprocessor()(args.export_frame)
+    ori_img_size = torch.tensor(ori_img.shape[:2], dtype=torch.float, device=device)
+    step = trace_motr_step(model, img.to(device), ori_img_size, args.num_warmup_frames)
+    step.save(args.export_path)
+    print(f'exported the tracking step for {tuple(img.shape[2:])} inputs to {args.export_path}')
+
+
+if __name__ == '__main__':
+    export()
@@ -0,0 +1,12 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+from .data import ImagePreprocessor, VideoReader, list_sequence_images, load_img_from_file
+from .tracker import MOTR
+from .sinks import ResultSink, MOTResultWriter, ImageWriter, VideoWriter, format_results
+from .pipeline import InferenceEngine, MultiSequenceEngine, TiledInferenceEngine, SequenceTask, FrameResult, build_inference_engine, configure_threads
+from .reuse import EncoderReuse
+from .keyframes import KeyframeScheduler
+from .tiling import TilePreprocessor, TileMerger, tile_grid
+from .traced import TracedMOTR, load_inference_model
@@ -0,0 +1,91 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+"""
+Frame sources and preprocessing for the inference engine.
+"""
+import os
+import cv2
+import torchvision.transforms.functional as F
+
+
+def list_sequence_images(img_dir):
+    img_list = os.listdir(img_dir)
+    img_list = [os.path.join(img_dir, _) for _ in img_list if ('jpg' in _) or ('png' in _)]
+    return sorted(img_list)
+
+
+def load_img_from_file(f_path):
+    cur_img = cv2.imread(f_path)
+    assert cur_img is not None, f_path
+    cur_img = cv2.cvtColor(cur_img, cv2.COLOR_BGR2RGB)
+    return cur_img
+
+
+class ImagePreprocessor(object):
+    """
+    Decodes (if needed), resizes and normalizes a single RGB frame.
+    Frames are given either as a path or as an RGB np.ndarray.
+    """
+    def __init__(self, img_height=800, img_width=1536):
+        '''
+        common settings
+        '''
+        self.img_height = img_height
+        self.img_width = img_width
+        self.mean = [0.485, 0.456, 0.406]
+        self.std = [0.229, 0.224, 0.225]
+
+    def transform(self, img):
+        """Resizes an RGB np.ndarray to the size bound and normalizes it into a [3, H, W] tensor."""
+        seq_h, seq_w = img.shape[:2]
+        scale = self.img_height / min(seq_h, seq_w)
+        if max(seq_h, seq_w) * scale > self.img_width:
+            scale = self.img_width / max(seq_h, seq_w)
+        target_h = int(seq_h * scale)
+        target_w = int(seq_w * scale)
+        img = cv2.resize(img, (target_w, target_h))
+        return F.normalize(F.to_tensor(img), self.mean, self.std)
+
+    def init_img(self, img):
+        ori_img = img.copy()
+        img = self.transform(img)
+        img = img.unsqueeze(0)
+        return img, ori_img
+
+    @staticmethod
+    def load(frame):
+        """Decodes a frame given as a path, without resizing it."""
+        if isinstance(frame, str):
+            frame = load_img_from_file(frame)
+        return frame
+
+    def __call__(self, frame):
+        return self.init_img(self.load(frame))
+
+
+class VideoReader(object):
+    """
+    Sequentially decodes the frames of a video file as RGB arrays.
+    """
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            raise FileExistsError
+
+        self.cap = cv2.VideoCapture(path)
+        self.frame_rate = int(round(self.cap.get(cv2.CAP_PROP_FPS)))
+        self.seq_w = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.seq_h = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.vn = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+        print('Lenth of the video: {:d} frames'.format(self.vn))
+
+    def __iter__(self):
+        for count in range(len(self)):
+            res, img = self.cap.read()  # BGR
+            assert img is not None, 'Failed to load frame {:d}'.format(count)
+            yield cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # RGB
+
+    def __len__(self):
+        return self.vn  # number of files
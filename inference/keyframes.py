@@ -0,0 +1,84 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+"""
+Keyframe scheduling: the full model only runs on keyframes, the frames in between get the output tracks
+of the last keyframe moved with a constant velocity, e.g. for long high frame rate videos where the objects
+move a few pixels per frame.
+"""
+import torch
+
+from models.structures import Instances
+
+
+class KeyframeScheduler(object):
+    """
+    Decides which frames of a sequence are keyframes and propagates the output tracks to the others.
+
+    The velocity of a track is the difference of its boxes [x1, y1, x2, y2] at the last two keyframes
+    where it was output, divided by the number of frames between them (zero for a new track).
+    Propagated tracks keep their obj_idxes, scores and labels, so the ids stay the same, and the model
+    state is left at the last keyframe, whose tracks the next keyframe starts from.
+    """
+    def __init__(self, interval, motion_thresh=0.0, min_score=0.0):
+        """
+        Args:
+            interval: largest number of frames from a keyframe to the next one.
+            motion_thresh: a frame is a keyframe when a track would have moved by more than this many
+                pixels since the last keyframe, or when the velocity of a track is not known yet. 0 disables it.
+            min_score: the frame after a keyframe where a track scored below this is a keyframe. 0 disables it.
+        """
+        self.interval = max(interval, 1)
+        self.motion_thresh = motion_thresh
+        self.min_score = min_score
+        self.num_frames = 0
+        self.num_keyframes = 0
+        self._last = None
+        self._velocity = None
+        self._since = 0
+        self._max_speed = 0.0
+        self._low_score = False
+        self._new_tracks = False
+
+    def is_keyframe(self) -> bool:
+        """Whether the next frame of the sequence is a keyframe, call it once per frame."""
+        self.num_frames += 1
+        if self._last is None or self._since + 1 >= self.interval or self._low_score:
+            return True
+        if self.motion_thresh <= 0:
+            return False
+        return self._new_tracks or self._max_speed * (self._since + 1) > self.motion_thresh
+
+    def update(self, dt_instances: Instances):
+        """Records the output tracks of a keyframe, as returned by select_output_instances."""
+        velocity = torch.zeros_like(dt_instances.boxes)
+        num_matched = 0
+        if self._last is not None and len(dt_instances) > 0 and len(self._last) > 0:
+            same = dt_instances.obj_idxes[:, None] == self._last.obj_idxes[None]
+            matched, prev = torch.nonzero(same, as_tuple=True)
+            velocity[matched] = (dt_instances.boxes[matched] - self._last.boxes[prev]) / (self._since + 1)
+            num_matched = len(matched)
+        self.num_keyframes += 1
+        self._last = dt_instances
+        self._velocity = velocity
+        self._since = 0
+        self._max_speed = float(velocity.abs().max()) if len(velocity) > 0 else 0.0
+        self._low_score = len(dt_instances) > 0 and float(dt_instances.scores.min()) < self.min_score
+        self._new_tracks = num_matched < len(dt_instances)
+
+    def propagate(self, ori_img_size) -> Instances:
+        """The output tracks of the last keyframe at the next frame, which is not a keyframe."""
+        self._since += 1
+        img_h, img_w = ori_img_size
+        boxes = self._last.boxes + self._velocity * self._since
+        max_xy = boxes.new_tensor([img_w, img_h, img_w, img_h])
+        boxes = torch.min(boxes.clamp(min=0), max_xy)
+        dt_instances = Instances(self._last.image_size)
+        dt_instances.boxes = boxes
+        dt_instances.scores = self._last.scores
+        dt_instances.labels = self._last.labels
+        dt_instances.obj_idxes = self._last.obj_idxes
+        # tracks that left the frame.
+        keep = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+        return dt_instances[keep]
@@ -0,0 +1,645 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+"""
+Streaming inference engine shared by submit.py, submit_dance.py, eval.py and demo.py.
+
+A sequence is processed by four stages connected by bounded queues:
+    decode/preprocess (thread pool) -> model step and on-device filtering -> ID bookkeeping -> visualization (thread pool) -> sinks
+Every stage runs on its own thread, so cv2 decoding and result writing overlap with the model.
+Thread pools keep the frame order.
+With pipeline_encoder, the model step is itself split in two stages: the backbone and encoder, which only
+depend on the frame, encode the next frame (on their own cuda stream) while the decoder tracks the current one.
+With encode_chunk > 1, they encode the frames of a sequence in batches, then the decoder tracks them one by one.
+With encoder_reuse_thresh > 0, frames that barely differ from the last encoded one reuse its encoder outputs.
+With keyframe_interval > 1, the model only runs on keyframes and the tracks are propagated in between.
+
+MultiSequenceEngine runs the same stages over many sequences, advancing up to `batch_size` of them
+in lockstep so that their frames share one backbone and encoder pass.
+TiledInferenceEngine tracks overlapping tiles of high resolution frames in the same way, see tiling.py.
+"""
+import contextlib
+import copy
+import itertools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import torch
+from tqdm import tqdm
+
+from models.structures import Instances
+
+from .data import ImagePreprocessor
+from .keyframes import KeyframeScheduler
+from .reuse import EncoderReuse
+from .tiling import TilePreprocessor, TileMerger
+from .tracker import MOTR
+from .visualize import visualize_img_with_bbox
+
+
+class _Failure(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+_END = object()
+
+
+def background(iterable, queue_size):
+    """Consumes `iterable` on a worker thread and yields its items through a bounded queue."""
+    q = queue.Queue(maxsize=max(queue_size, 1))
+
+    def worker():
+        try:
+            for item in iterable:
+                q.put(item)
+        except BaseException as e:
+            q.put(_Failure(e))
+        else:
+            q.put(_END)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    while True:
+        item = q.get()
+        if item is _END:
+            break
+        if isinstance(item, _Failure):
+            raise item.exc
+        yield item
+
+
+def ordered_map(fn, iterable, num_workers, queue_size):
+    """Applies `fn` on a pool of `num_workers` threads and yields the results in input order."""
+    if num_workers <= 0:
+        for item in iterable:
+            yield fn(item)
+        return
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        for future in background((executor.submit(fn, item) for item in iterable), queue_size):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=False)
+
+
+def tensor_to_numpy(tensor: torch.Tensor):
+    return tensor.detach().cpu().numpy()
+
+
+def select_output_instances(track_instances: Instances, prob_threshold, area_threshold):
+    """
+    Applies the score and area filters on the model device and copies the fields read by the
+    tracker (boxes, scores, labels, obj_idxes) to the host as one packed float64 tensor.
+    Returns:
+        dt_instances: the kept instances on the cpu.
+        max_obj_idx: the largest obj_idx over all instances before filtering, -1 if there are none.
+    """
+    boxes = track_instances.boxes
+    scores = track_instances.scores
+    wh = boxes[:, 2:4] - boxes[:, 0:2]
+    keep = (scores > prob_threshold) & (wh[:, 0] * wh[:, 1] > area_threshold)
+    # float64 represents float32 values and obj ids exactly.
+    packed = torch.cat([boxes[keep].double(),
+                        scores[keep, None].double(),
+                        track_instances.labels[keep, None].double(),
+                        track_instances.obj_idxes[keep, None].double()], dim=1)
+    max_obj_idx = track_instances.obj_idxes.max() if len(track_instances) > 0 else track_instances.obj_idxes.new_full((), -1)
+    packed = torch.cat([packed.flatten(), max_obj_idx.double()[None]]).cpu()
+
+    rows = packed[:-1].view(-1, 7)
+    dt_instances = Instances(track_instances.image_size)
+    dt_instances.boxes = rows[:, :4].to(boxes.dtype)
+    dt_instances.scores = rows[:, 4].to(scores.dtype)
+    dt_instances.labels = rows[:, 5].long()
+    dt_instances.obj_idxes = rows[:, 6].long()
+    return dt_instances, int(packed[-1])
+
+
+def _new_stats():
+    return {'num_frames': 0, 'total_dts': 0, 'total_occlusion_dts': 0, 'max_id': 0}
+
+
+class FrameResult(object):
+    def __init__(self, index, ori_img, dt_instances, ref_pts=None, max_obj_idx=-1):
+        self.index = index
+        self.frame_id = index + 1
+        self.ori_img = ori_img
+        self.dt_instances = dt_instances
+        self.ref_pts = ref_pts
+        self.max_obj_idx = max_obj_idx
+        self.tracker_outputs = None
+        self.vis_img = None
+
+
+class InferenceEngine(object):
+    def __init__(self, model, num_decode_workers=2, num_output_workers=1, queue_size=8, preprocessor=None,
+                 pipeline_encoder=False, encode_chunk=1, encoder_reuse_thresh=0.0, max_encoder_reuse=4,
+                 keyframe_interval=1, keyframe_motion_thresh=0.0, keyframe_min_score=0.0):
+        """
+        Parameters:
+            model: MOTR model in eval mode, already moved to its inference device.
+            num_decode_workers: threads decoding and normalizing frames. 0 runs inline.
+            num_output_workers: threads rendering visualizations. 0 runs inline.
+            queue_size: capacity of the queue between two stages.
+            pipeline_encoder: encode the next frame on another thread while the current one is decoded,
+                the results are the same. Requires the python MOTR.
+            encode_chunk: number of frames encoded in one batch before they are decoded one by one.
+                The frames of a sequence have the same size and are not padded. Requires the python MOTR.
+            encoder_reuse_thresh: largest change (see EncoderReuse) under which a frame skips the backbone and
+                encoder and is decoded from the outputs of the last encoded frame. 0 encodes every frame.
+                Requires the python MOTR.
+            max_encoder_reuse: number of consecutive frames that may reuse the same encoder outputs.
+            keyframe_interval: run the model at least every this many frames, and only on keyframes (see
+                KeyframeScheduler). The other frames get the tracks of the last keyframe moved with a constant
+                velocity. 1 runs the model on every frame. Cannot be combined with the options above, which
+                encode frames ahead of the decoder. The decode workers then only decode the frames and
+                the model stage resizes and normalizes the keyframes, the other frames are never preprocessed.
+            keyframe_motion_thresh: a frame is also a keyframe when a track would have moved by more than this
+                many pixels since the last keyframe. 0 disables it.
+            keyframe_min_score: the frame after a keyframe where an output track scored below this is a keyframe.
+        """
+        assert (not pipeline_encoder and encode_chunk <= 1 and encoder_reuse_thresh <= 0) \
+            or hasattr(model, 'encode_frame'), \
+            'the encoder can only be pipelined, batched or reused with the python model, not with a traced step.'
+        assert keyframe_interval <= 1 or not (pipeline_encoder or encode_chunk > 1 or encoder_reuse_thresh > 0), \
+            'keyframes are chosen from the outputs of the previous frames, frames cannot be encoded ahead.'
+        self.model = model
+        self.num_decode_workers = num_decode_workers
+        self.num_output_workers = num_output_workers
+        self.queue_size = queue_size
+        self.preprocessor = preprocessor if preprocessor is not None else ImagePreprocessor()
+        self.pipeline_encoder = pipeline_encoder
+        self.encode_chunk = max(encode_chunk, 1)
+        self.encoder_reuse_thresh = encoder_reuse_thresh
+        self.max_encoder_reuse = max_encoder_reuse
+        self.keyframe_interval = keyframe_interval
+        self.keyframe_motion_thresh = keyframe_motion_thresh
+        self.keyframe_min_score = keyframe_min_score
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def _new_track_base(self):
+        # every sequence counts its object ids from zero.
+        if self.model.track_base is None:
+            return None
+        track_base = copy.copy(self.model.track_base)
+        track_base.clear()
+        return track_base
+
+    def _decode_stage(self, frames, keyframes=None):
+        # with keyframes, the frames are only decoded here and the model stage preprocesses the keyframes.
+        fn = self.preprocessor.load if keyframes is not None else self.preprocessor
+        return ordered_map(fn, frames, self.num_decode_workers, self.queue_size)
+
+    @staticmethod
+    def _make_result(index, ori_img, res, with_ref_pts, prob_threshold, area_threshold):
+        ref_pts = tensor_to_numpy(res['ref_pts'][0, :, :2]) if with_ref_pts else None
+        dt_instances, max_obj_idx = select_output_instances(res['track_instances'], prob_threshold, area_threshold)
+        return FrameResult(index, ori_img, dt_instances, ref_pts, max_obj_idx)
+
+    def _encode_stage(self, frames, reuse=None):
+        """
+        Encodes chunks of frames with the stateless half of the model, on a side stream on cuda.
+        With `reuse`, the frames it does not need to encode get the outputs of the last encoded frame.
+        """
+        device = self.device
+        stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        frames = iter(frames)
+        last_encoded = None
+        while True:
+            chunk = list(itertools.islice(frames, self.encode_chunk))
+            if len(chunk) == 0:
+                break
+            if reuse is not None:
+                needs_encoding = [reuse.needs_encoding(cur_img) for cur_img, _ in chunk]
+            else:
+                needs_encoding = [True] * len(chunk)
+            imgs = [cur_img for (cur_img, _), needed in zip(chunk, needs_encoding) if needed]
+            with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+                if len(imgs) == 0:
+                    encoded = []
+                elif len(imgs) == 1:
+                    encoded = [self.model.encode_frame(imgs[0].to(device).float())]
+                else:
+                    encoded = self.model.encode_frames(torch.cat(imgs).to(device).float())
+            event = stream.record_event() if stream is not None else None
+            encoded = iter(encoded)
+            for (_, ori_img), needed in zip(chunk, needs_encoding):
+                if needed:
+                    last_encoded = next(encoded)
+                yield ori_img, last_encoded, event
+
+    @staticmethod
+    def _wait_encoded(encoded, event, device):
+        """Makes the current stream wait for the encoding stream and keeps the outputs alive for it."""
+        if event is None:
+            return
+        stream = torch.cuda.current_stream(device)
+        stream.wait_event(event)
+        for v in encoded.values():
+            if isinstance(v, torch.Tensor):
+                v.record_stream(stream)
+
+    def _model_stage(self, frames, with_ref_pts, prob_threshold, area_threshold, reuse=None, keyframes=None):
+        device = self.device
+        track_instances = None
+        split = self.pipeline_encoder or self.encode_chunk > 1 or reuse is not None
+        if split:
+            frames = self._encode_stage(frames, reuse)
+        if self.pipeline_encoder:
+            # a single encoded frame waits for the decoder, the next one is being encoded.
+            frames = background(frames, 1)
+        for i, frame in enumerate(frames):
+            if keyframes is not None:
+                if not keyframes.is_keyframe():
+                    yield FrameResult(i, frame, keyframes.propagate(frame.shape[:2]))
+                    continue
+                frame = self.preprocessor(frame)
+            if track_instances is not None:
+                track_instances.remove('boxes')
+                track_instances.remove('labels')
+
+            if split:
+                ori_img, encoded, event = frame
+                self._wait_encoded(encoded, event, device)
+                res = self.model.track_encoded_frame(encoded, ori_img.shape[:2], track_instances)
+            else:
+                cur_img, ori_img = frame
+                seq_h, seq_w = ori_img.shape[:2]
+                res = self.model.inference_single_image(cur_img.to(device).float(), (seq_h, seq_w), track_instances)
+            track_instances = res['track_instances']
+            result = self._make_result(i, ori_img, res, with_ref_pts, prob_threshold, area_threshold)
+            if keyframes is not None:
+                keyframes.update(result.dt_instances)
+            yield result
+
+    @staticmethod
+    def _count_and_track(result, tr_tracker, stats):
+        dt_instances = result.dt_instances
+        occluded = dt_instances.labels == 1
+        stats['max_id'] = max(stats['max_id'], result.max_obj_idx)
+        stats['total_dts'] += len(dt_instances)
+        stats['total_occlusion_dts'] += int(occluded.sum())
+        # occluded detections are marked by a negative score for the tracker and the visualizations.
+        # not in place: the model stage may still hold the scores, e.g. for the keyframes.
+        dt_instances.scores = torch.where(occluded, -dt_instances.scores, dt_instances.scores)
+        result.tracker_outputs = tr_tracker.update(dt_instances)
+        return result
+
+    def _track_stage(self, results, stats):
+        tr_tracker = MOTR()
+        for result in results:
+            yield self._count_and_track(result, tr_tracker, stats)
+
+    @staticmethod
+    def _render(result):
+        result.vis_img = visualize_img_with_bbox(result.ori_img, result.dt_instances, ref_pts=result.ref_pts)
+        return result
+
+    def run(self, frames, sinks=(), prob_threshold=0.7, area_threshold=100, draw_ref_pts=False):
+        """
+        Tracks a single sequence.
+        Parameters:
+            frames: iterable of image paths or RGB np.ndarray frames, in temporal order.
+            sinks: list of ResultSink receiving every frame in order. They are closed at the end.
+            draw_ref_pts: whether visualizations also show the reference points of all queries.
+        Returns:
+            dict of statistics over the sequence.
+        """
+        stats = _new_stats()
+        start = time.perf_counter()
+        vis = any(sink.needs_vis for sink in sinks)
+        total = len(frames) if hasattr(frames, '__len__') else None
+        reuse = None
+        if self.encoder_reuse_thresh > 0:
+            reuse = EncoderReuse(self.encoder_reuse_thresh, self.max_encoder_reuse)
+        keyframes = None
+        if self.keyframe_interval > 1:
+            keyframes = KeyframeScheduler(self.keyframe_interval, self.keyframe_motion_thresh, self.keyframe_min_score)
+
+        results = self._decode_stage(frames, keyframes)
+        results = background(self._model_stage(results, vis and draw_ref_pts, prob_threshold, area_threshold,
+                                                reuse, keyframes), self.queue_size)
+        results = background(self._track_stage(results, stats), self.queue_size)
+        if vis:
+            results = ordered_map(self._render, results, self.num_output_workers, self.queue_size)
+        try:
+            for result in tqdm(results, total=total):
+                for sink in sinks:
+                    sink.write(result)
+                stats['num_frames'] += 1
+        finally:
+            for sink in sinks:
+                sink.close()
+        stats['fps'] = stats['num_frames'] / (time.perf_counter() - start)
+        self._report_speed(stats['num_frames'], stats['fps'])
+        if reuse is not None:
+            stats['num_reused_encodings'] = reuse.num_reused
+            stats['encoder_reuse_rate'] = reuse.reuse_rate
+            print('reused the encoder outputs for {}/{} frames ({:.1%})'.format(
+                reuse.num_reused, reuse.num_frames, reuse.reuse_rate))
+        if keyframes is not None:
+            stats['num_keyframes'] = keyframes.num_keyframes
+            print('ran the model on {}/{} keyframes'.format(keyframes.num_keyframes, keyframes.num_frames))
+        return stats
+
+    def _report_speed(self, num_frames, fps):
+        print('{} frames at {:.2f} FPS on {} ({} threads)'.format(num_frames, fps, self.device, torch.get_num_threads()))
+
+
+class SequenceTask(object):
+    """A sequence to track with MultiSequenceEngine, and the sinks receiving its results."""
+    def __init__(self, name, frames, sinks=()):
+        self.name = name
+        self.frames = frames
+        self.sinks = list(sinks)
+
+
+class _SequenceState(object):
+    """Per-sequence state of MultiSequenceEngine: model tracks, ID counter and tracker."""
+    def __init__(self, task, frames, track_base, draw_ref_pts, group=0):
+        self.task = task
+        self.group = group
+        self.frames = iter(frames)
+        self.vis = any(sink.needs_vis for sink in task.sinks)
+        self.with_ref_pts = self.vis and draw_ref_pts
+        self.index = 0
+        self.track_instances = None
+        self.track_base = track_base
+        self.tr_tracker = MOTR()
+        self.stats = _new_stats()
+
+
+class _SequenceEnd(object):
+    def __init__(self, state):
+        self.state = state
+
+
+class MultiSequenceEngine(InferenceEngine):
+    def __init__(self, model, batch_size=4, group_size=1, **kwargs):
+        """
+        Parameters:
+            batch_size: number of sequences advanced in lockstep. When a sequence ends, the
+                next pending one takes its place in the batch.
+            group_size: number of consecutive tasks that always share a batch, e.g. the views of a scene.
+                The slots of a group are only refilled, with the next group, once all its sequences ended.
+            kwargs: see InferenceEngine.
+        """
+        super().__init__(model, **kwargs)
+        assert batch_size % group_size == 0, 'the batch has to hold whole groups of sequences.'
+        self.batch_size = batch_size
+        self.group_size = group_size
+
+    def _open_sequence(self, task, draw_ref_pts, group=0):
+        return _SequenceState(task, self._decode_stage(task.frames), self._new_track_base(), draw_ref_pts, group)
+
+    def _next_batch(self, running, pending, draw_ref_pts):
+        """Pulls the next frame of every running sequence, swapping finished groups of sequences for pending ones."""
+        batch = []
+        ended = []
+        for state in running:
+            frame = next(state.frames, None)
+            if frame is None:
+                ended.append(state)
+            else:
+                batch.append((state, frame))
+        # a group keeps its slots while one of its sequences is running.
+        num_groups = len({state.group for state, _ in batch})
+        while (num_groups + 1) * self.group_size <= self.batch_size:
+            group, tasks = next(pending, (None, None))
+            if tasks is None:
+                break
+            num_groups += 1
+            for task in tasks:
+                state = self._open_sequence(task, draw_ref_pts, group)
+                frame = next(state.frames, None)
+                if frame is None:
+                    ended.append(state)
+                else:
+                    batch.append((state, frame))
+        return batch, ended
+
+    def _batched_model_stage(self, tasks, draw_ref_pts, prob_threshold, area_threshold):
+        device = self.device
+        pending = enumerate(tasks[i:i + self.group_size] for i in range(0, len(tasks), self.group_size))
+        running = []
+        while True:
+            batch, ended = self._next_batch(running, pending, draw_ref_pts)
+            for state in ended:
+                yield _SequenceEnd(state)
+            if len(batch) == 0:
+                break
+            running = [state for state, _ in batch]
+
+            imgs, ori_img_sizes, track_instances_list = [], [], []
+            for state, (cur_img, ori_img) in batch:
+                if state.track_instances is not None:
+                    state.track_instances.remove('boxes')
+                    state.track_instances.remove('labels')
+                imgs.append(cur_img[0].to(device).float())
+                ori_img_sizes.append(ori_img.shape[:2])
+                track_instances_list.append(state.track_instances)
+            track_bases = [state.track_base for state in running]
+
+            rets = self.model.inference_multi_image(imgs, ori_img_sizes, track_instances_list, track_bases)
+            for (state, (_, ori_img)), res in zip(batch, rets):
+                state.track_instances = res['track_instances']
+                result = self._make_result(state.index, ori_img, res, state.with_ref_pts, prob_threshold, area_threshold)
+                result.sequence = state
+                state.index += 1
+                yield result
+
+    def _batched_track_stage(self, results):
+        for result in results:
+            if not isinstance(result, _SequenceEnd):
+                state = result.sequence
+                result = self._count_and_track(result, state.tr_tracker, state.stats)
+            yield result
+
+    @staticmethod
+    def _render_if_needed(result):
+        if not isinstance(result, _SequenceEnd) and result.sequence.vis:
+            InferenceEngine._render(result)
+        return result
+
+    def run_sequences(self, tasks, prob_threshold=0.7, area_threshold=100, draw_ref_pts=False):
+        """
+        Tracks many sequences.
+        Parameters:
+            tasks: list of SequenceTask. The sinks of a task are closed once its last frame is written.
+            draw_ref_pts: whether visualizations also show the reference points of all queries.
+        Returns:
+            dict mapping the name of every task to the statistics over its sequence.
+        """
+        tasks = list(tasks)
+        all_stats = {}
+        total = None
+        if all(hasattr(task.frames, '__len__') for task in tasks):
+            total = sum(len(task.frames) for task in tasks)
+
+        results = background(self._batched_model_stage(tasks, draw_ref_pts, prob_threshold, area_threshold), self.queue_size)
+        results = background(self._batched_track_stage(results), self.queue_size)
+        if any(sink.needs_vis for task in tasks for sink in task.sinks):
+            results = ordered_map(self._render_if_needed, results, self.num_output_workers, self.queue_size)
+        closed = set()
+        start = time.perf_counter()
+        pbar = tqdm(total=total)
+        try:
+            for result in results:
+                if isinstance(result, _SequenceEnd):
+                    task = result.state.task
+                    for sink in task.sinks:
+                        sink.close()
+                    closed.add(id(task))
+                    all_stats[task.name] = result.state.stats
+                    continue
+                for sink in result.sequence.task.sinks:
+                    sink.write(result)
+                result.sequence.stats['num_frames'] += 1
+                pbar.update(1)
+        finally:
+            pbar.close()
+            for task in tasks:
+                if id(task) not in closed:
+                    for sink in task.sinks:
+                        sink.close()
+        num_frames = sum(stats['num_frames'] for stats in all_stats.values())
+        self._report_speed(num_frames, num_frames / (time.perf_counter() - start))
+        return all_stats
+
+
+class TiledInferenceEngine(InferenceEngine):
+    def __init__(self, model, tile_size=(1080, 1920), tile_overlap=128, tile_match_thresh=0.5, **kwargs):
+        """
+        Parameters:
+            tile_size: (h, w) of the tiles in pixels of the original frames. Every tile is resized like
+                the preprocessor resizes whole frames.
+            tile_overlap: smallest overlap in pixels of two neighbouring tiles, about the size of the largest objects.
+            tile_match_thresh: see TileMerger.
+            kwargs: see InferenceEngine. The encoder cannot be pipelined, batched over frames or reused.
+        """
+        super().__init__(model, **kwargs)
+        assert not (self.pipeline_encoder or self.encode_chunk > 1 or self.encoder_reuse_thresh > 0), \
+            'the tiles of a frame are already encoded in one batch.'
+        self.preprocessor = TilePreprocessor(self.preprocessor, tile_size, tile_overlap)
+        self.tile_match_thresh = tile_match_thresh
+
+    def _model_stage(self, frames, with_ref_pts, prob_threshold, area_threshold, reuse=None, keyframes=None):
+        device = self.device
+        merger = TileMerger(self.tile_match_thresh)
+        track_instances_list = None
+        for i, frame in enumerate(frames):
+            if keyframes is not None:
+                if not keyframes.is_keyframe():
+                    yield FrameResult(i, frame, keyframes.propagate(frame.shape[:2]))
+                    continue
+                frame = self.preprocessor(frame)
+            tiles, ori_img = frame
+            if track_instances_list is None:
+                track_instances_list = [None] * len(tiles)
+                track_bases = [self._new_track_base() for _ in range(len(tiles))]
+            for track_instances in track_instances_list:
+                if track_instances is not None:
+                    track_instances.remove('boxes')
+                    track_instances.remove('labels')
+
+            corners, tile_size = self.preprocessor.grid(ori_img.shape[:2])
+            rets = self.model.inference_multi_image(tiles.to(device).float(), [tile_size] * len(tiles),
+                                                    track_instances_list, track_bases)
+            track_instances_list = [res['track_instances'] for res in rets]
+            dt_instances = merger.merge([select_output_instances(res['track_instances'], prob_threshold, area_threshold)[0]
+                                         for res in rets], corners, ori_img.shape[:2])
+            merger.prune([res['track_instances'].obj_idxes for res in rets])
+            ref_pts = None
+            if with_ref_pts:
+                ref_pts = torch.cat([res['ref_pts'][0, :, :2] + res['ref_pts'].new_tensor(corner) for res, corner in zip(rets, corners)])
+                ref_pts = tensor_to_numpy(ref_pts)
+            result = FrameResult(i, ori_img, dt_instances, ref_pts, merger.num_ids - 1)
+            if keyframes is not None:
+                keyframes.update(result.dt_instances)
+            yield result
+
+
+def _single_sequence_options(args):
+    """The inference options set in args that only apply to single sequence inference."""
+    options = {'--pipeline_encoder': args.pipeline_encoder,
+               '--encode_chunk': args.encode_chunk > 1,
+               '--encoder_reuse_thresh': args.encoder_reuse_thresh > 0,
+               '--keyframe_interval': args.keyframe_interval > 1,
+               '--tile_size': args.tile_size is not None}
+    return [name for name, is_set in options.items() if is_set]
+
+
+def build_inference_engine(args, model):
+    if args.batch_sequences > 1:
+        options = _single_sequence_options(args)
+        assert len(options) == 0, \
+            '--batch_sequences cannot be combined with {}, which only apply to single sequence inference.'.format(
+                ', '.join(options))
+        return MultiSequenceEngine(model,
+                                   batch_size=args.batch_sequences,
+                                   num_decode_workers=args.num_decode_workers,
+                                   num_output_workers=args.num_output_workers,
+                                   queue_size=args.queue_size)
+    kwargs = dict(num_decode_workers=args.num_decode_workers,
+                  num_output_workers=args.num_output_workers,
+                  queue_size=args.queue_size,
+                  pipeline_encoder=args.pipeline_encoder,
+                  encode_chunk=args.encode_chunk,
+                  encoder_reuse_thresh=args.encoder_reuse_thresh,
+                  max_encoder_reuse=args.max_encoder_reuse,
+                  keyframe_interval=args.keyframe_interval,
+                  keyframe_motion_thresh=args.keyframe_motion_thresh,
+                  keyframe_min_score=args.keyframe_min_score)
+    if args.tile_size is not None:
+        return TiledInferenceEngine(model,
+                                    tile_size=args.tile_size,
+                                    tile_overlap=args.tile_overlap,
+                                    tile_match_thresh=args.tile_match_thresh,
+                                    **kwargs)
+    return InferenceEngine(model, **kwargs)
+
+
+def _num_available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def configure_threads(args):
+    """
+    Sets the torch thread pools for inference. Call it before building the model.
+    On cpu the model gets the cores left by the decode and output workers, and cv2 runs single
+    threaded since frames are already decoded in parallel. A pipelined encoder and the decoder run at
+    the same time, each with its own intra-op threads, so they share these cores.
+    """
+    on_cpu = torch.device(args.device).type == 'cpu'
+    num_threads = args.num_threads
+    if num_threads <= 0 and on_cpu:
+        num_threads = max(1, _num_available_cores() - args.num_decode_workers - args.num_output_workers)
+        if args.pipeline_encoder and args.batch_sequences <= 1:
+            num_threads = max(1, num_threads // 2)
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    num_interop_threads = args.num_interop_threads
+    if num_interop_threads <= 0 and on_cpu:
+        # the model runs one op at a time.
+        num_interop_threads = 1
+    if num_interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # it can only be set once, before any inter-op parallel work.
+            print('keep {} inter-op threads'.format(torch.get_num_interop_threads()))
+    if on_cpu:
+        cv2.setNumThreads(1)
+    print('inference on {} with {} intra-op and {} inter-op threads'.format(
+        args.device, torch.get_num_threads(), torch.get_num_interop_threads()))
@@ -0,0 +1,58 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+"""
+Reuse of the encoder outputs of a frame for the next ones when they barely change, e.g. fixed cameras
+or hovering drones. Only the backbone and the encoder are skipped, the decoder still runs every frame.
+"""
+import torch
+import torch.nn.functional as F
+
+
+class EncoderReuse(object):
+    """
+    Decides, frame after frame, whether a frame needs to be encoded or can reuse the encoder outputs of
+    the last encoded one (the reference). The change of a frame is the largest mean absolute difference
+    with the reference over blocks of `block_size` pixels (the stride of the coarsest feature level) of the
+    normalized images, so that a small moving object is not averaged out by a static background.
+    """
+    def __init__(self, threshold, max_reuse=4, block_size=32, downsample=4):
+        """
+        Args:
+            threshold: largest change under which a frame reuses the encoder outputs of the reference.
+            max_reuse: number of consecutive frames that may reuse the same outputs.
+        """
+        assert block_size % downsample == 0
+        self.threshold = threshold
+        self.max_reuse = max_reuse
+        self.block_size = block_size
+        self.downsample = downsample
+        self.num_frames = 0
+        self.num_reused = 0
+        self._reference = None
+        self._num_consecutive = 0
+
+    def _summary(self, img):
+        return F.avg_pool2d(img.float(), self.downsample, ceil_mode=True)
+
+    def change(self, summary):
+        diff = (summary - self._reference).abs().mean(1, keepdim=True)
+        return float(F.avg_pool2d(diff, self.block_size // self.downsample, ceil_mode=True).max())
+
+    def needs_encoding(self, img: torch.Tensor) -> bool:
+        """img: the normalized [1, 3, H, W] frame, the next one of the sequence."""
+        self.num_frames += 1
+        summary = self._summary(img)
+        if self._reference is not None and self._reference.shape == summary.shape \
+                and self._num_consecutive < self.max_reuse and self.change(summary) <= self.threshold:
+            self._num_consecutive += 1
+            self.num_reused += 1
+            return False
+        self._reference = summary
+        self._num_consecutive = 0
+        return True
+
+    @property
+    def reuse_rate(self) -> float:
+        return self.num_reused / max(self.num_frames, 1)
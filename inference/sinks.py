@@ -0,0 +1,128 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+"""
+Result sinks consumed by the output stage of the inference engine.
+A sink receives every FrameResult of a sequence in frame order.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+
+class ResultSink(object):
+    needs_vis = False
+
+    def write(self, result):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+def format_results(rows):
+    """Formats rows of [frame, id, x1, y1, w, h] as lines of the MOT challenge txt format."""
+    save_format = '%d,%d,%r,%r,%r,%r,1,-1,-1,-1\n'
+    return ''.join([save_format % (frame_id, track_id, x1, y1, w, h) for frame_id, track_id, x1, y1, w, h in rows.tolist()])
+
+
+class MOTResultWriter(ResultSink):
+    """
+    Writes tracker outputs in the MOT challenge txt format.
+    Rows are accumulated in a preallocated buffer, then formatted and appended to the file in bulk
+    on a background thread, so the output stage never waits for the filesystem.
+    With save_npz, the rows of the whole sequence are also saved next to the txt as
+    <name>.npz with the arrays frame_ids, track_ids and boxes (x1, y1, w, h).
+    """
+    def __init__(self, txt_path, save_npz=False, buffer_rows=8192):
+        self.txt_path = txt_path
+        self.npz_path = os.path.splitext(txt_path)[0] + '.npz' if save_npz else None
+        if os.path.exists(txt_path):
+            os.remove(txt_path)
+        self.buffer_rows = buffer_rows
+        self._buffer = np.empty((buffer_rows, 6), dtype=np.float64)
+        self._num_rows = 0
+        self._chunks = []
+        # a single worker keeps the flushes in order.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = []
+
+    def write(self, result):
+        tracker_outputs = result.tracker_outputs
+        tracker_outputs = tracker_outputs[tracker_outputs[:, 5] >= 0]
+        num_rows = len(tracker_outputs)
+        if self._num_rows + num_rows > len(self._buffer):
+            self.flush()
+            if num_rows > len(self._buffer):
+                self._buffer = np.empty((num_rows, 6), dtype=np.float64)
+        rows = self._buffer[self._num_rows:self._num_rows + num_rows]
+        rows[:, 0] = result.frame_id
+        rows[:, 1] = tracker_outputs[:, 5]
+        rows[:, 2:4] = tracker_outputs[:, :2]
+        rows[:, 4:6] = tracker_outputs[:, 2:4] - tracker_outputs[:, :2]
+        self._num_rows += num_rows
+
+    def _append(self, rows):
+        with open(self.txt_path, 'a') as f:
+            f.write(format_results(rows))
+
+    def flush(self):
+        """Hands the buffered rows over to the background thread."""
+        if self._num_rows == 0:
+            return
+        rows = self._buffer[:self._num_rows]
+        self._buffer = np.empty((self.buffer_rows, 6), dtype=np.float64)
+        self._num_rows = 0
+        if self.npz_path is not None:
+            self._chunks.append(rows)
+        for future in self._futures:
+            if future.done():
+                # re-raises the error of a failed flush.
+                future.result()
+        self._futures = [future for future in self._futures if not future.done()]
+        self._futures.append(self._executor.submit(self._append, rows))
+
+    def close(self):
+        self.flush()
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._executor.shutdown(wait=True)
+        if self.npz_path is not None:
+            rows = np.concatenate(self._chunks) if len(self._chunks) > 0 else np.zeros((0, 6), dtype=np.float64)
+            np.savez(self.npz_path,
+                     frame_ids=rows[:, 0].astype(np.int64),
+                     track_ids=rows[:, 1].astype(np.int64),
+                     boxes=rows[:, 2:6])
+
+
+class ImageWriter(ResultSink):
+    """Dumps the visualization of every frame as an image file."""
+    needs_vis = True
+
+    def __init__(self, save_dir, name_format='frame_{}.jpg'):
+        self.save_dir = save_dir
+        self.name_format = name_format
+        os.makedirs(save_dir, exist_ok=True)
+
+    def write(self, result):
+        img_path = os.path.join(self.save_dir, self.name_format.format(result.index))
+        cv2.imwrite(img_path, result.vis_img)
+
+
+class VideoWriter(ResultSink):
+    """Appends the visualization of every frame to a MJPG video."""
+    needs_vis = True
+
+    def __init__(self, video_path, fps, frame_size):
+        self.writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'), fps, frame_size)
+
+    def write(self, result):
+        self.writer.write(result.vis_img)
+
+    def close(self):
+        self.writer.release()
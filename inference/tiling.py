@@ -0,0 +1,154 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+"""
+Tiled inference for high resolution frames with small objects, e.g. 4K drone footage.
+
+Every frame is split into overlapping tiles of the same size, cut from the original frame, so that a tile is
+downscaled much less than the whole frame would be. The tiles of a frame share one backbone and encoder pass
+and every tile is tracked with its own track instances, like the sequences of MultiSequenceEngine.
+Their output tracks are then moved to frame coordinates and the duplicates in the overlaps are merged,
+before the ID bookkeeping (see TiledInferenceEngine in pipeline.py).
+"""
+import math
+
+import torch
+
+from models.structures import Instances
+
+
+def _tile_starts(size, tile, overlap):
+    if tile >= size:
+        return [0]
+    assert overlap < tile, 'the tiles have to be larger than their overlap.'
+    num_tiles = math.ceil((size - tile) / (tile - overlap)) + 1
+    # evenly spread, the last tile is flush with the border.
+    return [round(i * (size - tile) / (num_tiles - 1)) for i in range(num_tiles)]
+
+
+def tile_grid(img_size, tile_size, overlap):
+    """
+    Tiles covering a frame.
+    Args:
+        img_size: (h, w) of the frame.
+        tile_size: (h, w) of the tiles, clipped to the frame.
+        overlap: smallest overlap in pixels of two neighbouring tiles.
+    Returns:
+        the (x, y) of the top-left corner of every tile, row by row, and the (h, w) of the tiles.
+    """
+    tile_h, tile_w = min(tile_size[0], img_size[0]), min(tile_size[1], img_size[1])
+    corners = [(x, y) for y in _tile_starts(img_size[0], tile_h, overlap)
+               for x in _tile_starts(img_size[1], tile_w, overlap)]
+    return corners, (tile_h, tile_w)
+
+
+class TilePreprocessor(object):
+    """
+    Splits a frame into tiles and resizes and normalizes every tile like `preprocessor` does whole frames.
+    Returns the [num_tiles, 3, H, W] tiles and the frame.
+    """
+    def __init__(self, preprocessor, tile_size, overlap):
+        self.preprocessor = preprocessor
+        self.tile_size = tile_size
+        self.overlap = overlap
+
+    def grid(self, img_size):
+        return tile_grid(img_size, self.tile_size, self.overlap)
+
+    def load(self, frame):
+        return self.preprocessor.load(frame)
+
+    def __call__(self, frame):
+        frame = self.load(frame)
+        corners, (tile_h, tile_w) = self.grid(frame.shape[:2])
+        tiles = [self.preprocessor.transform(frame[y:y + tile_h, x:x + tile_w]) for x, y in corners]
+        return torch.stack(tiles), frame
+
+
+class TileMerger(object):
+    """
+    Merges the output tracks of the tiles of the frames of a sequence.
+
+    A track overlapping a higher scoring track of another tile by more than `match_thresh` of the area of the
+    smaller box is a duplicate and dropped. The area of the smaller box, rather than the union, matches the
+    boxes cut by the border of a tile with the whole box of the neighbouring tile.
+    Tracks get the ids of the sequence from the (tile, obj_idx) of their tile. When a duplicate pairs a known
+    track with a new one, the new one takes the id of the known one, so that an object keeps its id when it
+    moves from a tile to the next. The pairs are forgotten once their tile track is dropped (see prune).
+    """
+    def __init__(self, match_thresh=0.5):
+        self.match_thresh = match_thresh
+        self.ids = {}
+        self.num_ids = 0
+
+    @staticmethod
+    def _overlap_over_smaller(boxes):
+        area = (boxes[:, 2] - boxes[:, 0]).clamp(min=0) * (boxes[:, 3] - boxes[:, 1]).clamp(min=0)
+        lt = torch.max(boxes[:, None, :2], boxes[None, :, :2])
+        rb = torch.min(boxes[:, None, 2:], boxes[None, :, 2:])
+        wh = (rb - lt).clamp(min=0)
+        inter = wh[..., 0] * wh[..., 1]
+        return inter / torch.min(area[:, None], area[None]).clamp(min=1e-6)
+
+    def _link(self, key, other):
+        """Gives the id of `other` to `key` if only `other` has one."""
+        if key not in self.ids and other in self.ids:
+            self.ids[key] = self.ids[other]
+
+    def prune(self, obj_idxes_list):
+        """
+        Forgets the (tile, obj_idx) pairs of the tracks that their tile no longer tracks, so that the ids
+        do not grow with the length of the sequence.
+        Args:
+            obj_idxes_list: the obj_idxes of all the track instances of every tile, after the frame.
+        """
+        alive = set()
+        for i, obj_idxes in enumerate(obj_idxes_list):
+            alive.update((i, obj_idx) for obj_idx in obj_idxes.tolist())
+        self.ids = {key: obj_idx for key, obj_idx in self.ids.items() if key in alive}
+
+    def merge(self, dt_instances_list, corners, img_size) -> Instances:
+        """
+        Args:
+            dt_instances_list: the output tracks of every tile, in tile coordinates.
+            corners: the (x, y) of the top-left corner of every tile.
+            img_size: (h, w) of the frame.
+        Returns:
+            the merged tracks in frame coordinates, with the ids of the sequence as obj_idxes.
+        """
+        boxes = torch.cat([dt.boxes + dt.boxes.new_tensor([x, y, x, y]) for dt, (x, y) in zip(dt_instances_list, corners)])
+        scores = torch.cat([dt.scores for dt in dt_instances_list])
+        labels = torch.cat([dt.labels for dt in dt_instances_list])
+        tiles = torch.cat([torch.full((len(dt), ), i, dtype=torch.long) for i, dt in enumerate(dt_instances_list)])
+        keys = list(zip(tiles.tolist(), torch.cat([dt.obj_idxes for dt in dt_instances_list]).tolist()))
+
+        order = torch.argsort(scores, descending=True).tolist()
+        duplicate = (self._overlap_over_smaller(boxes) > self.match_thresh) & (tiles[:, None] != tiles[None])
+        duplicate = duplicate.tolist()
+        kept = []
+        for i in order:
+            matches = [k for k in kept if duplicate[i][k]]
+            if len(matches) > 0:
+                self._link(keys[matches[0]], keys[i])
+                self._link(keys[i], keys[matches[0]])
+            else:
+                kept.append(i)
+
+        obj_idxes = []
+        for k in kept:
+            obj_idx = self.ids.get(keys[k])
+            # a sequence id is output once per frame.
+            if obj_idx is None or obj_idx in obj_idxes:
+                obj_idx = self.num_ids
+                self.num_ids += 1
+                self.ids[keys[k]] = obj_idx
+            obj_idxes.append(obj_idx)
+
+        kept = torch.as_tensor(kept, dtype=torch.long)
+        merged = Instances(tuple(img_size))
+        merged.boxes = boxes[kept]
+        merged.scores = scores[kept]
+        merged.labels = labels[kept]
+        merged.obj_idxes = torch.as_tensor(obj_idxes, dtype=torch.long)
+        return merged
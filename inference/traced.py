@@ -0,0 +1,61 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+"""
+Model loading for the inference entry points, either the python MOTR or a tracking step exported by export.py.
+"""
+import torch
+
+from models import build_model
+from models.structures import Instances
+from util.tool import load_model
+
+
+class TracedMOTR(object):
+    """
+    Runs a tracking step exported by export.py (see models/motr_step.py) behind the interface of MOTR
+    used by the inference engine. The step only accepts frames of the size it was exported with.
+    """
+    # the id counter is part of the traced state.
+    track_base = None
+
+    def __init__(self, path, device):
+        self.step = torch.jit.load(path, map_location=device)
+        self.step.eval()
+
+    def parameters(self):
+        return self.step.parameters()
+
+    def clear(self):
+        pass
+
+    @torch.no_grad()
+    def inference_single_image(self, img, ori_img_size, track_instances=None):
+        state = self.step.initial_state() if track_instances is None else track_instances._state
+        img_size = torch.as_tensor(ori_img_size, dtype=torch.float, device=img.device)
+        (boxes, scores, labels, obj_idxes, ref_pts), state = self.step(img, img_size, state)
+        track_instances = Instances(tuple(ori_img_size))
+        track_instances.boxes = boxes
+        track_instances.scores = scores
+        track_instances.labels = labels
+        track_instances.obj_idxes = obj_idxes
+        track_instances._state = state
+        return {'track_instances': track_instances, 'ref_pts': ref_pts}
+
+    def inference_multi_image(self, imgs, ori_img_sizes, track_instances_list, track_bases):
+        # the step is traced for a single frame, sequences run one after the other.
+        return [self.inference_single_image(img[None], ori_img_size, track_instances)
+                for img, ori_img_size, track_instances in zip(imgs, ori_img_sizes, track_instances_list)]
+
+
+def load_inference_model(args):
+    """Loads the step exported to --traced_model if given, otherwise builds MOTR with the weights of --resume."""
+    if args.traced_model:
+        return TracedMOTR(args.traced_model, args.device)
+    model, _, _ = build_model(args)
+    model = load_model(model, args.resume)
+    model.eval()
+    if args.fold_backbone_bn or args.channels_last:
+        model.backbone[0].optimize_for_inference(args.fold_backbone_bn, args.channels_last)
+    return model.to(args.device)
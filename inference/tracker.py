@@ -0,0 +1,108 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+"""
+    SORT: A Simple, Online and Realtime Tracker
+    Copyright (C) 2016-2020 Alex Bewley alex@bewley.ai
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import numpy as np
+
+from models.structures import Instances
+
+
+class MOTR(object):
+    def __init__(self, max_age=1, min_hits=3, iou_threshold=0.3, max_miss=10):
+        """
+        Sets key parameters for SORT
+        """
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.iou_threshold = iou_threshold
+        self.max_miss = max_miss
+        self.frame_count = 0
+        # track table, one row per track: obj id, consecutive missed frames,
+        # last [x1, y1, x2, y2, score] and whether the track is active (not occluded or lost).
+        self.ids = np.empty((0, ), dtype=np.int64)
+        self.miss = np.empty((0, ), dtype=np.int64)
+        self.boxes = np.empty((0, 5), dtype=np.float64)
+        self.active = np.empty((0, ), dtype=bool)
+        self.disappeared_tracks = []
+
+    def clear_disappeared_track(self):
+        self.disappeared_tracks = []
+
+    def _lookup(self, obj_idxes):
+        """Returns the row of every id in the track table, -1 for unknown ids."""
+        if len(self.ids) == 0:
+            return np.full(len(obj_idxes), -1, dtype=np.int64)
+        order = np.argsort(self.ids)
+        sorted_ids = self.ids[order]
+        pos = np.minimum(np.searchsorted(sorted_ids, obj_idxes), len(sorted_ids) - 1)
+        return np.where(sorted_ids[pos] == obj_idxes, order[pos], -1)
+
+    def update(self, dt_instances: Instances):
+        """
+        Params:
+          dt_instances - filtered detections with boxes [x1, y1, x2, y2], scores, labels (0: visible, 1: occluded) and obj_idxes.
+        Requires: this method must be called once for each frame even with empty detections.
+        Returns a numpy array [[x1, y1, x2, y2, score, id], ...] of the visible detections, where id is obj_idx + 1.
+        """
+        self.frame_count += 1
+        obj_idxes = np.asarray(dt_instances.obj_idxes, dtype=np.int64)
+        labels = np.asarray(dt_instances.labels)
+        boxes = np.asarray(dt_instances.boxes)
+        scores = np.asarray(dt_instances.scores)
+        box_with_score = np.concatenate([boxes, scores[:, None]], axis=-1)
+        positive = labels == 0
+        occluded = labels == 1
+
+        # tracks missing in this frame become inactive.
+        unmatched = ~np.isin(self.ids, obj_idxes)
+        self.active[unmatched] = False
+        self.miss[unmatched] += 1
+
+        # positive tracks are set active, occluded tracks inactive.
+        rows = self._lookup(obj_idxes)
+        found = rows >= 0
+        pos_rows = rows[found & positive]
+        self.active[pos_rows] = True
+        self.miss[pos_rows] = 0
+        self.boxes[pos_rows] = box_with_score[found & positive]
+        occ_rows = rows[found & occluded]
+        self.active[occ_rows] = False
+        self.miss[occ_rows] += 1
+
+        # create the unknown tracks. A new occluded track starts inactive, with one missed frame and no box.
+        new = ~found & (positive | occluded)
+        new_boxes = np.full((int(new.sum()), 5), np.nan)
+        new_boxes[positive[new]] = box_with_score[new & positive]
+        self.ids = np.concatenate([self.ids, obj_idxes[new]])
+        self.miss = np.concatenate([self.miss, occluded[new].astype(np.int64)])
+        self.boxes = np.concatenate([self.boxes, new_boxes])
+        self.active = np.concatenate([self.active, positive[new]])
+
+        # drop the tracks that have been inactive for too long.
+        removed = ~self.active & (self.miss > self.max_miss)
+        if removed.any():
+            self.disappeared_tracks.extend(self.ids[removed].tolist())
+            keep = ~removed
+            self.ids = self.ids[keep]
+            self.miss = self.miss[keep]
+            self.boxes = self.boxes[keep]
+            self.active = self.active[keep]
+
+        ret = np.empty((int(positive.sum()), 6))
+        ret[:, :5] = box_with_score[positive]
+        ret[:, 5] = obj_idxes[positive] + 1  # +1 as MOT benchmark requires positive
+        return ret
@@ -157,6 +157,9 @@ def get_args_parser():
     parser.add_argument('--data_txt_path_val',
                         default='./datasets/data_path/detmot17.train', type=str,
                         help="path to dataset txt split")
+    parser.add_argument('--data_txt_path_test', default='', type=str,
+                        help="multi-drone split with the view folders '1' and '2' tracked by submit_multiview.py, "
+                             "defaults to <mot_path>/test")
     parser.add_argument('--img_path', default='data/valid/JPEGImages/')
 
     parser.add_argument('--query_interaction_layer', default='QIM', type=str,
@@ -177,6 +180,78 @@ def get_args_parser():
     parser.add_argument('--memory_bank_with_self_attn', action='store_true', default=False)
 
     parser.add_argument('--use_checkpoint', action='store_true', default=False)
+
+    # inference engine settings.
+    parser.add_argument('--num_decode_workers', type=int, default=2,
+                        help="threads decoding and normalizing frames during inference")
+    parser.add_argument('--num_output_workers', type=int, default=1,
+                        help="threads rendering visualizations during inference")
+    parser.add_argument('--queue_size', type=int, default=8,
+                        help="capacity of the queues between inference stages")
+    parser.add_argument('--num_threads', type=int, default=0,
+                        help="intra-op threads of torch during inference, 0 picks them from the device and the free cores")
+    parser.add_argument('--num_interop_threads', type=int, default=0,
+                        help="inter-op threads of torch during inference, 0 uses 1 on cpu and the torch default otherwise")
+    parser.add_argument('--fold_backbone_bn', action='store_true',
+                        help="fold the frozen BatchNorms of the backbone into its convs for inference")
+    parser.add_argument('--channels_last', action='store_true',
+                        help="run the backbone in the channels_last memory format during inference")
+    parser.add_argument('--traced_model', default='', type=str,
+                        help="tracking step exported by export.py, used by the inference scripts instead of --resume")
+    parser.add_argument('--save_npz', action='store_true',
+                        help="also save the tracking results of every sequence as a binary .npz next to the txt")
+    parser.add_argument('--pipeline_encoder', action='store_true',
+                        help="encode the next frame on another thread (and cuda stream) while the current one is "
+                             "decoded and tracked, with the same results, for single sequence inference")
+    parser.add_argument('--encode_chunk', type=int, default=1,
+                        help="offline single sequence inference: run the backbone and encoder on this many frames "
+                             "in one batch, then decode and track them one by one")
+    parser.add_argument('--encoder_reuse_thresh', type=float, default=0.0,
+                        help="single sequence inference: decode a frame from the encoder outputs of the last encoded "
+                             "frame when no 32x32 block of the normalized image changed by more than this on average "
+                             "since it, 0 to encode every frame")
+    parser.add_argument('--max_encoder_reuse', type=int, default=4,
+                        help="number of consecutive frames that may reuse the same encoder outputs")
+    parser.add_argument('--keyframe_interval', type=int, default=1,
+                        help="single sequence inference: run the model at least every this many frames and only on "
+                             "keyframes, the tracks are moved with a constant velocity in between, 1 runs every frame")
+    parser.add_argument('--keyframe_motion_thresh', type=float, default=0.0,
+                        help="also run the model when a track would have moved by more than this many pixels "
+                             "since the last keyframe, 0 to disable")
+    parser.add_argument('--keyframe_min_score', type=float, default=0.0,
+                        help="also run the model on the frame after a keyframe where an output track scored "
+                             "below this, 0 to disable")
+    parser.add_argument('--tile_size', type=int, nargs=2, default=None, metavar=('H', 'W'),
+                        help="single sequence inference on high resolution frames: track overlapping tiles of this "
+                             "size (in pixels of the original frames) in one batch and merge their tracks")
+    parser.add_argument('--tile_overlap', type=int, default=128,
+                        help="smallest overlap in pixels of two neighbouring tiles")
+    parser.add_argument('--tile_match_thresh', type=float, default=0.5,
+                        help="tracks of two tiles whose intersection covers more than this fraction of the smaller "
+                             "box are merged")
+    parser.add_argument('--batch_sequences', type=int, default=1,
+                        help="number of sequences tracked in lockstep, sharing the backbone and encoder pass. "
+                             "Exclusive with the single sequence options --pipeline_encoder, --encode_chunk, "
+                             "--encoder_reuse_thresh, --keyframe_interval and --tile_size")
+    parser.add_argument('--max_tracks', type=int, default=0,
+                        help="keep the tracks of a sequence in a store of this many reusable slots (grown when full) "
+                             "instead of rebuilding the track instances every frame, 0 to disable")
+    parser.add_argument('--detect_prune_layer', type=int, default=0,
+                        help="at inference, drop the detect queries scoring below --detect_prune_thresh after this "
+                             "many decoder layers, the next layers only run on the remaining queries, 0 to disable")
+    parser.add_argument('--detect_prune_thresh', type=float, default=0.05,
+                        help="score under which --detect_prune_layer drops a detect query")
+    parser.add_argument('--eval_dec_layers', type=int, default=0,
+                        help="only run this many decoder layers at inference, predicting with the heads of the last one, "
+                             "0 for all of them")
+
+    # * Decoder distillation
+    parser.add_argument('--distill_teacher', default='', type=str,
+                        help="checkpoint of a trained MOTR whose decoder is distilled into the --dec_layers ones of the "
+                             "trained model, e.g. initialized with --pretrained from the same checkpoint")
+    parser.add_argument('--teacher_dec_layers', default=6, type=int, help="decoder layers of the teacher")
+    parser.add_argument('--distill_loss_coef', default=1, type=float,
+                        help="weight of the distillation losses, relative to the ones of the ground truth")
     return parser
 
 
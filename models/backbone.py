@@ -22,6 +22,7 @@ from torchvision.models._utils import IntermediateLayerGetter
 from typing import Dict, List
 
 from util.misc import NestedTensor, is_main_process
+from util.cache import ShapeCache, mask_key, set_mask_key
 from .position_encoding import build_position_encoding
 
 class FrozenBatchNorm2d(torch.nn.Module):
@@ -64,6 +65,41 @@ class FrozenBatchNorm2d(torch.nn.Module):
         return x * scale + bias
 
 
+def _conv_bn_pairs(name: str, parent: nn.Module):
+    """Names of the (conv, bn) children of a module of a torchvision ResNet: convN/bnN and downsample[0]/[1]."""
+    children = dict(parent.named_children())
+    if name.split('.')[-1] == 'downsample':
+        return [('0', '1')] if '1' in children else []
+    return [('conv' + bn_name[2:], bn_name) for bn_name in children if bn_name.startswith('bn')]
+
+
+@torch.no_grad()
+def fold_frozen_batchnorm(module: nn.Module) -> int:
+    """
+    Folds the FrozenBatchNorm2d of the torchvision ResNets (conv1/bn1, ..., downsample[0]/downsample[1])
+    into the weight and bias of their conv, and replaces them by an identity.
+    For inference only: the folded module can not load the original checkpoints any more.
+    Returns the number of folded layers.
+    """
+    num_folded = 0
+    for name, parent in list(module.named_modules()):
+        for conv_name, bn_name in _conv_bn_pairs(name, parent):
+            conv, bn = getattr(parent, conv_name, None), getattr(parent, bn_name)
+            if not isinstance(bn, FrozenBatchNorm2d):
+                continue
+            assert isinstance(conv, nn.Conv2d) and conv.out_channels == bn.weight.numel(), \
+                '{}.{} does not follow a conv with as many channels, it can not be folded.'.format(name, bn_name)
+            scale = bn.weight * (bn.running_var + bn.eps).rsqrt()
+            bias = bn.bias - bn.running_mean * scale
+            if conv.bias is not None:
+                bias = bias + conv.bias * scale
+            conv.weight.mul_(scale.reshape(-1, 1, 1, 1))
+            conv.bias = nn.Parameter(bias, requires_grad=conv.weight.requires_grad)
+            setattr(parent, bn_name, nn.Identity())
+            num_folded += 1
+    return num_folded
+
+
 class BackboneBase(nn.Module):
 
     def __init__(self, backbone: nn.Module, train_backbone: bool, return_interm_layers: bool):
@@ -74,27 +110,50 @@ class BackboneBase(nn.Module):
             
         if return_interm_layers:
             return_layers = {"layer2": "0", "layer3": "1", "layer4": "2"}
-            self.strides = [8, 16, 32]
-            self.num_channels = [512, 1024, 2048]
         else:
             return_layers = {'layer4': "0"}
-            self.strides = [32]
-            self.num_channels = [2048]
         self.body = IntermediateLayerGetter(backbone, return_layers=return_layers)
+        self.strides, self.num_channels = self._probe_layers()
+        self._mask_cache = ShapeCache()
+        self.channels_last = False
+
+    @torch.no_grad()
+    def _probe_layers(self, size=64):
+        """Runs a blank image through the body to find the stride and the channels of every returned layer."""
+        xs = self.body(torch.zeros((1, 3, size, size)))
+        return [size // x.shape[-1] for x in xs.values()], [x.shape[1] for x in xs.values()]
+
+    def optimize_for_inference(self, fold_bn=True, channels_last=False):
+        """Folds the frozen BatchNorms into the convs and/or runs the body in the channels_last memory format."""
+        if fold_bn:
+            fold_frozen_batchnorm(self.body)
+        if channels_last:
+            self.body.to(memory_format=torch.channels_last)
+            self.channels_last = True
 
     def forward(self, tensor_list: NestedTensor):
-        xs = self.body(tensor_list.tensors)
+        m = tensor_list.mask
+        assert m is not None
+        # keyed before the body runs, so that reading the mask does not wait for it.
+        key = mask_key(m)
+        x = tensor_list.tensors
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        xs = self.body(x)
         out: Dict[str, NestedTensor] = {}
         for name, x in xs.items():
-            m = tensor_list.mask
-            assert m is not None
-            mask = F.interpolate(m[None].float(), size=x.shape[-2:]).to(torch.bool)[0]
+            level_key = (key, tuple(x.shape[-2:]))
+            mask = self._mask_cache(level_key, lambda: set_mask_key(
+                F.interpolate(m[None].float(), size=x.shape[-2:]).to(torch.bool)[0], level_key), enabled=not self.training)
             out[name] = NestedTensor(x, mask)
         return out
 
 
 class Backbone(BackboneBase):
-    """ResNet backbone with frozen BatchNorm."""
+    """
+    torchvision ResNet (resnet18/34/50/101, resnext, wide_resnet) backbone with frozen BatchNorm.
+    The strides and channels of the returned layers are probed, so input_proj fits any of them.
+    """
     def __init__(self, name: str,
                  train_backbone: bool,
                  return_interm_layers: bool,
@@ -103,10 +162,7 @@ class Backbone(BackboneBase):
         backbone = getattr(torchvision.models, name)(
             replace_stride_with_dilation=[False, False, dilation],
             pretrained=is_main_process(), norm_layer=norm_layer)
-        assert name not in ('resnet18', 'resnet34'), "number of channels are hard coded"
         super().__init__(backbone, train_backbone, return_interm_layers)
-        if dilation:
-            self.strides[-1] = self.strides[-1] // 2
 
 
 class Joiner(nn.Sequential):
@@ -21,6 +21,7 @@ from torch.nn.init import xavier_uniform_, constant_, uniform_, normal_
 from models.structures import Boxes, matched_boxlist_iou, pairwise_iou
 
 from util.misc import inverse_sigmoid
+from util.cache import ShapeCache, mask_key
 from util.box_ops import box_cxcywh_to_xyxy
 from models.ops.modules import MSDeformAttn
 
@@ -50,7 +51,9 @@ class DeformableTransformer(nn.Module):
                                                           dropout, activation,
                                                           num_feature_levels, nhead, dec_n_points, decoder_self_cross,
                                                           sigmoid_attn=sigmoid_attn, extra_track_attn=extra_track_attn)
-        self.decoder = DeformableTransformerDecoder(decoder_layer, num_decoder_layers, return_intermediate_dec)
+        # the detect queries come first, one per proposal in two-stage, followed by the track queries.
+        self.decoder = DeformableTransformerDecoder(decoder_layer, num_decoder_layers, return_intermediate_dec,
+                                                    num_queries=two_stage_num_proposals)
 
         self.level_embed = nn.Parameter(torch.Tensor(num_feature_levels, d_model))
 
@@ -61,6 +64,7 @@ class DeformableTransformer(nn.Module):
             self.pos_trans_norm = nn.LayerNorm(d_model * 2)
         else:
             self.reference_points = nn.Linear(d_model, 2)
+        self._geometry_cache = ShapeCache()
 
         self._reset_parameters()
 
@@ -132,50 +136,99 @@ class DeformableTransformer(nn.Module):
         valid_ratio = torch.stack([valid_ratio_w, valid_ratio_h], -1)
         return valid_ratio
 
-    def forward(self, srcs, masks, pos_embeds, query_embed=None, ref_pts=None):
-        assert self.two_stage or query_embed is not None
-
+    def _build_geometry(self, masks):
+        spatial_shapes = torch.as_tensor([m.shape[-2:] for m in masks], dtype=torch.long, device=masks[0].device)
+        level_start_index = torch.cat((spatial_shapes.new_zeros((1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
+        valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
+        return {
+            'mask_flatten': torch.cat([m.flatten(1) for m in masks], 1),
+            'spatial_shapes': spatial_shapes,
+            'level_start_index': level_start_index,
+            'valid_ratios': valid_ratios,
+            'reference_points': self.encoder.get_reference_points(spatial_shapes, valid_ratios, device=masks[0].device),
+        }
+
+    def encode(self, srcs, masks, pos_embeds):
+        """
+        Runs the image-only part of the transformer. Its outputs do not depend on the queries,
+        so they can be batched over frames of different sequences.
+        """
         # prepare input for encoder
         src_flatten = []
-        mask_flatten = []
         lvl_pos_embed_flatten = []
-        spatial_shapes = []
-        for lvl, (src, mask, pos_embed) in enumerate(zip(srcs, masks, pos_embeds)):
-            bs, c, h, w = src.shape
-            spatial_shape = (h, w)
-            spatial_shapes.append(spatial_shape)
+        for lvl, (src, pos_embed) in enumerate(zip(srcs, pos_embeds)):
             src = src.flatten(2).transpose(1, 2)
-            mask = mask.flatten(1)
             pos_embed = pos_embed.flatten(2).transpose(1, 2)
             lvl_pos_embed = pos_embed + self.level_embed[lvl].view(1, 1, -1)
             lvl_pos_embed_flatten.append(lvl_pos_embed)
             src_flatten.append(src)
-            mask_flatten.append(mask)
         src_flatten = torch.cat(src_flatten, 1)
-        mask_flatten = torch.cat(mask_flatten, 1)
         lvl_pos_embed_flatten = torch.cat(lvl_pos_embed_flatten, 1)
-        spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long, device=src_flatten.device)
-        level_start_index = torch.cat((spatial_shapes.new_zeros((1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
-        valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
+        # the flattened masks, level shapes and encoder reference points only depend on the masks.
+        geometry = self._geometry_cache(tuple(mask_key(m) for m in masks), lambda: self._build_geometry(masks),
+                                        enabled=not self.training)
 
         # encoder
-        memory = self.encoder(src_flatten, spatial_shapes, level_start_index, valid_ratios, lvl_pos_embed_flatten, mask_flatten)
-        # prepare input for decoder
-        bs, _, c = memory.shape
-        if self.two_stage:
-            output_memory, output_proposals = self.gen_encoder_output_proposals(memory, mask_flatten, spatial_shapes)
-
-            # hack implementation for two-stage Deformable DETR
-            enc_outputs_class = self.decoder.class_embed[self.decoder.num_layers](output_memory)
+        memory = self.encoder(src_flatten, geometry['spatial_shapes'], geometry['level_start_index'],
+                              geometry['valid_ratios'], lvl_pos_embed_flatten, geometry['mask_flatten'],
+                              reference_points=geometry['reference_points'])
+        return {
+            'memory': memory,
+            'mask_flatten': geometry['mask_flatten'],
+            'spatial_shapes': geometry['spatial_shapes'],
+            'level_start_index': geometry['level_start_index'],
+            'valid_ratios': geometry['valid_ratios'],
+        }
+
+    def propose(self, encoded, num_proposals, all_boxes=True):
+        """
+        Two-stage: scores every encoder output as a proposal and turns the top `num_proposals` into queries.
+        Returns the [bs, num_proposals, 2 * d_model] query embeddings (position and content), the unnormalized
+        boxes of the proposals, and the class logits and unnormalized boxes of all the encoder outputs.
+        Without all_boxes, only the boxes of the top proposals are regressed and the last output is None.
+        """
+        memory = encoded['memory']
+        output_memory, output_proposals = self.gen_encoder_output_proposals(
+            memory, encoded['mask_flatten'], encoded['spatial_shapes'])
+
+        # hack implementation for two-stage Deformable DETR
+        enc_outputs_class = self.decoder.class_embed[self.decoder.num_layers](output_memory)
+        topk_proposals = torch.topk(enc_outputs_class[..., 0], num_proposals, dim=1)[1]
+        if all_boxes:
             enc_outputs_coord_unact = self.decoder.bbox_embed[self.decoder.num_layers](output_memory) + output_proposals
-
-            topk = self.two_stage_num_proposals
-            topk_proposals = torch.topk(enc_outputs_class[..., 0], topk, dim=1)[1]
             topk_coords_unact = torch.gather(enc_outputs_coord_unact, 1, topk_proposals.unsqueeze(-1).repeat(1, 1, 4))
-            topk_coords_unact = topk_coords_unact.detach()
+        else:
+            enc_outputs_coord_unact = None
+            topk_memory = torch.gather(output_memory, 1, topk_proposals.unsqueeze(-1).repeat(1, 1, memory.shape[-1]))
+            topk_coords_unact = self.decoder.bbox_embed[self.decoder.num_layers](topk_memory) \
+                + torch.gather(output_proposals, 1, topk_proposals.unsqueeze(-1).repeat(1, 1, 4))
+        topk_coords_unact = topk_coords_unact.detach()
+        pos_trans_out = self.pos_trans_norm(self.pos_trans(self.get_proposal_pos_embed(topk_coords_unact)))
+        return pos_trans_out, topk_coords_unact, enc_outputs_class, enc_outputs_coord_unact
+
+    def decode(self, encoded, query_embed=None, ref_pts=None, last_layer_only=False, query_filter=None, num_layers=None):
+        """
+        Runs the decoder on the outputs of `encode`. With last_layer_only, the intermediate outputs are not
+        kept: hs is the last layer and inter_references the reference points given to it, both of length 1.
+        query_filter drops queries between the layers and num_layers truncates the decoder, see
+        DeformableTransformerDecoder.
+        In two-stage, the queries are the encoder proposals unless query_embed is given.
+        """
+        assert self.two_stage or query_embed is not None
+        memory = encoded['memory']
+        mask_flatten = encoded['mask_flatten']
+        spatial_shapes = encoded['spatial_shapes']
+        level_start_index = encoded['level_start_index']
+        valid_ratios = encoded['valid_ratios']
+
+        # prepare input for decoder
+        bs, _, c = memory.shape
+        enc_outputs_class = enc_outputs_coord_unact = None
+        if query_embed is None:
+            pos_trans_out, topk_coords_unact, enc_outputs_class, enc_outputs_coord_unact = self.propose(
+                encoded, self.two_stage_num_proposals)
             reference_points = topk_coords_unact.sigmoid()
             init_reference_out = reference_points
-            pos_trans_out = self.pos_trans_norm(self.pos_trans(self.get_proposal_pos_embed(topk_coords_unact)))
             query_embed, tgt = torch.split(pos_trans_out, c, dim=2)
         else:
             query_embed, tgt = torch.split(query_embed, c, dim=1)
@@ -189,12 +242,17 @@ class DeformableTransformer(nn.Module):
             init_reference_out = reference_points
         # decoder
         hs, inter_references = self.decoder(tgt, reference_points, memory,
-                                            spatial_shapes, level_start_index, valid_ratios, query_embed, mask_flatten)
+                                            spatial_shapes, level_start_index, valid_ratios, query_embed, mask_flatten,
+                                            last_layer_only=last_layer_only, query_filter=query_filter,
+                                            num_layers=num_layers)
 
         inter_references_out = inter_references
-        if self.two_stage:
-            return hs, init_reference_out, inter_references_out, enc_outputs_class, enc_outputs_coord_unact
-        return hs, init_reference_out, inter_references_out, None, None
+        return hs, init_reference_out, inter_references_out, enc_outputs_class, enc_outputs_coord_unact
+
+    def forward(self, srcs, masks, pos_embeds, query_embed=None, ref_pts=None):
+        assert self.two_stage or query_embed is not None
+        encoded = self.encode(srcs, masks, pos_embeds)
+        return self.decode(encoded, query_embed, ref_pts=ref_pts)
 
 
 class DeformableTransformerEncoderLayer(nn.Module):
@@ -259,9 +317,11 @@ class DeformableTransformerEncoder(nn.Module):
         reference_points = reference_points[:, :, None] * valid_ratios[:, None]
         return reference_points
 
-    def forward(self, src, spatial_shapes, level_start_index, valid_ratios, pos=None, padding_mask=None):
+    def forward(self, src, spatial_shapes, level_start_index, valid_ratios, pos=None, padding_mask=None,
+                reference_points=None):
         output = src
-        reference_points = self.get_reference_points(spatial_shapes, valid_ratios, device=src.device)
+        if reference_points is None:
+            reference_points = self.get_reference_points(spatial_shapes, valid_ratios, device=src.device)
         for _, layer in enumerate(self.layers):
             output = layer(output, pos, reference_points, spatial_shapes, level_start_index, padding_mask)
 
@@ -317,9 +377,9 @@ class DeformableTransformerDecoderLayer(nn.Module):
         tgt = self.norm3(tgt)
         return tgt
 
-    def _forward_self_attn(self, tgt, query_pos, attn_mask=None):
+    def _forward_self_attn(self, tgt, query_pos, num_detect, attn_mask=None):
         if self.extra_track_attn:
-            tgt = self._forward_track_attn(tgt, query_pos)
+            tgt = self._forward_track_attn(tgt, query_pos, num_detect)
 
         q = k = self.with_pos_embed(tgt, query_pos)
         if attn_mask is not None:
@@ -330,20 +390,21 @@ class DeformableTransformerDecoderLayer(nn.Module):
         tgt = tgt + self.dropout2(tgt2)
         return self.norm2(tgt)
 
-    def _forward_track_attn(self, tgt, query_pos):
+    def _forward_track_attn(self, tgt, query_pos, num_detect):
         q = k = self.with_pos_embed(tgt, query_pos)
-        if q.shape[1] > 300:
-            tgt2 = self.update_attn(q[:, 300:].transpose(0, 1),
-                                    k[:, 300:].transpose(0, 1),
-                                    tgt[:, 300:].transpose(0, 1))[0].transpose(0, 1)
-            tgt = torch.cat([tgt[:, :300],self.norm4(tgt[:, 300:]+self.dropout5(tgt2))], dim=1)
+        # a traced step keeps the general path, it also handles no track query.
+        if torch.jit.is_tracing() or q.shape[1] > num_detect:
+            tgt2 = self.update_attn(q[:, num_detect:].transpose(0, 1),
+                                    k[:, num_detect:].transpose(0, 1),
+                                    tgt[:, num_detect:].transpose(0, 1))[0].transpose(0, 1)
+            tgt = torch.cat([tgt[:, :num_detect],self.norm4(tgt[:, num_detect:]+self.dropout5(tgt2))], dim=1)
         return tgt
 
     def _forward_self_cross(self, tgt, query_pos, reference_points, src, src_spatial_shapes, level_start_index,
-                            src_padding_mask=None, attn_mask=None):
+                            src_padding_mask=None, attn_mask=None, num_detect=300):
 
         # self attention
-        tgt = self._forward_self_attn(tgt, query_pos, attn_mask)
+        tgt = self._forward_self_attn(tgt, query_pos, num_detect, attn_mask)
         # cross attention
         tgt2 = self.cross_attn(self.with_pos_embed(tgt, query_pos),
                                reference_points,
@@ -357,7 +418,7 @@ class DeformableTransformerDecoderLayer(nn.Module):
         return tgt
 
     def _forward_cross_self(self, tgt, query_pos, reference_points, src, src_spatial_shapes, level_start_index,
-                            src_padding_mask=None, attn_mask=None):
+                            src_padding_mask=None, attn_mask=None, num_detect=300):
         # cross attention
         tgt2 = self.cross_attn(self.with_pos_embed(tgt, query_pos),
                                reference_points,
@@ -365,45 +426,60 @@ class DeformableTransformerDecoderLayer(nn.Module):
         tgt = tgt + self.dropout1(tgt2)
         tgt = self.norm1(tgt)
         # self attention
-        tgt = self._forward_self_attn(tgt, query_pos, attn_mask)
+        tgt = self._forward_self_attn(tgt, query_pos, num_detect, attn_mask)
         # ffn
         tgt = self.forward_ffn(tgt)
 
         return tgt
 
-    def forward(self, tgt, query_pos, reference_points, src, src_spatial_shapes, level_start_index, src_padding_mask=None):
+    def forward(self, tgt, query_pos, reference_points, src, src_spatial_shapes, level_start_index, src_padding_mask=None,
+                num_detect=300):
+        """num_detect: number of detect queries, in front of the track queries."""
         attn_mask = None
         if self.self_cross:
             return self._forward_self_cross(tgt, query_pos, reference_points, src, src_spatial_shapes,
-                                            level_start_index, src_padding_mask, attn_mask)
+                                            level_start_index, src_padding_mask, attn_mask, num_detect)
         return self._forward_cross_self(tgt, query_pos, reference_points, src, src_spatial_shapes, level_start_index,
-                                        src_padding_mask, attn_mask)
+                                        src_padding_mask, attn_mask, num_detect)
 
 
 class DeformableTransformerDecoder(nn.Module):
-    def __init__(self, decoder_layer, num_layers, return_intermediate=False):
+    def __init__(self, decoder_layer, num_layers, return_intermediate=False, num_queries=300):
         super().__init__()
         self.layers = _get_clones(decoder_layer, num_layers)
         self.num_layers = num_layers
+        self.num_queries = num_queries
         self.return_intermediate = return_intermediate
         # hack implementation for iterative bounding box refinement and two-stage Deformable DETR
         self.bbox_embed = None
         self.class_embed = None
 
     def forward(self, tgt, reference_points, src, src_spatial_shapes, src_level_start_index, src_valid_ratios,
-                query_pos=None, src_padding_mask=None):
+                query_pos=None, src_padding_mask=None, last_layer_only=False, query_filter=None, num_layers=None):
+        """
+        query_filter: optional, with last_layer_only. Called after every layer but the last as
+            query_filter(lid, output, reference points given to the layer), returns the indices of the queries
+            kept by the next layers or None to keep all of them. The outputs then only hold the kept queries.
+        num_layers: only runs the first num_layers layers, all of them by default.
+        """
+        assert query_filter is None or last_layer_only
+        if num_layers is None:
+            num_layers = self.num_layers
         output = tgt
+        num_detect = self.num_queries
 
         intermediate = []
         intermediate_reference_points = []
-        for lid, layer in enumerate(self.layers):
+        for lid, layer in enumerate(self.layers[:num_layers]):
+            layer_reference_points = reference_points
             if reference_points.shape[-1] == 4:
                 reference_points_input = reference_points[:, :, None] \
                                          * torch.cat([src_valid_ratios, src_valid_ratios], -1)[:, None]
             else:
                 assert reference_points.shape[-1] == 2
                 reference_points_input = reference_points[:, :, None] * src_valid_ratios[:, None]
-            output = layer(output, query_pos, reference_points_input, src, src_spatial_shapes, src_level_start_index, src_padding_mask)
+            output = layer(output, query_pos, reference_points_input, src, src_spatial_shapes, src_level_start_index, src_padding_mask,
+                           num_detect)
 
             # hack implementation for iterative bounding box refinement
             if self.bbox_embed is not None:
@@ -418,10 +494,21 @@ class DeformableTransformerDecoder(nn.Module):
                     new_reference_points = new_reference_points.sigmoid()
                 reference_points = new_reference_points.detach()
 
-            if self.return_intermediate:
+            if self.return_intermediate and not last_layer_only:
                 intermediate.append(output)
                 intermediate_reference_points.append(reference_points)
 
+            if query_filter is not None and lid < num_layers - 1:
+                keep = query_filter(lid, output, layer_reference_points)
+                if keep is not None:
+                    num_detect = int((keep < num_detect).sum())
+                    output = output[:, keep]
+                    reference_points = reference_points[:, keep]
+                    if query_pos is not None:
+                        query_pos = query_pos[:, keep]
+
+        if last_layer_only:
+            return output[None], layer_reference_points[None]
         if self.return_intermediate:
             return torch.stack(intermediate), torch.stack(intermediate_reference_points)
 
@@ -11,6 +11,91 @@ from typing import List
 from models.structures import Instances
 
 
+class TrackMemory(object):
+    """
+    The memory bank of every row of the track instances, stored as ring buffers that are only allocated
+    for the rows saved into. It is a field of Instances: indexing keeps the buffers of the selected rows
+    and cat concatenates them, so the detect queries never carry a bank.
+    """
+    def __init__(self, index: Tensor, bank: Tensor, valid: Tensor, ptr: Tensor):
+        # buffer of every row, -1 for rows that have never been saved.
+        self.index = index
+        # [num_buffers, mem_len, dim] saved embeddings, whether each slot was written and the next slot to write.
+        self.bank = bank
+        self.valid = valid
+        self.ptr = ptr
+
+    @classmethod
+    def empty(cls, num_rows, mem_len, dim, device):
+        return cls(torch.full((num_rows, ), -1, dtype=torch.long, device=device),
+                   torch.zeros((0, mem_len, dim), dtype=torch.float32, device=device),
+                   torch.zeros((0, mem_len), dtype=torch.bool, device=device),
+                   torch.zeros((0, ), dtype=torch.long, device=device))
+
+    def tensors(self):
+        return self.index, self.bank, self.valid, self.ptr
+
+    def __len__(self):
+        return self.index.__len__()
+
+    def __getitem__(self, item) -> "TrackMemory":
+        index = self.index[item]
+        has_buffer = index >= 0
+        # renumber the kept buffers in row order.
+        new_index = torch.where(has_buffer, has_buffer.cumsum(0) - 1, index)
+        buffers = index[has_buffer]
+        return TrackMemory(new_index, self.bank[buffers], self.valid[buffers], self.ptr[buffers])
+
+    @staticmethod
+    def cat(memories: List["TrackMemory"]) -> "TrackMemory":
+        index = []
+        num_buffers = 0
+        for m in memories:
+            index.append(torch.where(m.index >= 0, m.index + num_buffers, m.index))
+            num_buffers = num_buffers + m.bank.shape[0]
+        return TrackMemory(torch.cat(index),
+                           torch.cat([m.bank for m in memories]),
+                           torch.cat([m.valid for m in memories]),
+                           torch.cat([m.ptr for m in memories]))
+
+    def to(self, *args, **kwargs) -> "TrackMemory":
+        return TrackMemory(*(t.to(*args, **kwargs) for t in self.tensors()))
+
+    def allocate(self, rows: Tensor) -> "TrackMemory":
+        """Returns the memory with an empty buffer for every row in `rows` that has none."""
+        missing = rows[self.index[rows] < 0]
+        if not torch.jit.is_tracing() and missing.shape[0] == 0:
+            return self
+        num_buffers = self.bank.shape[0]
+        index = self.index.clone()
+        index[missing] = num_buffers + torch.arange(missing.shape[0], device=index.device)
+        bank = torch.cat([self.bank, self.bank.new_zeros((missing.shape[0], ) + self.bank.shape[1:])])
+        valid = torch.cat([self.valid, self.valid.new_zeros((missing.shape[0], ) + self.valid.shape[1:])])
+        ptr = torch.cat([self.ptr, self.ptr.new_zeros((missing.shape[0], ))])
+        return TrackMemory(index, bank, valid, ptr)
+
+    def write(self, buffers: Tensor, embed: Tensor, inplace=True):
+        """Writes one embedding into each of `buffers`, overwriting the oldest once a buffer is full."""
+        ptr = self.ptr[buffers]
+        if inplace:
+            self.bank[buffers, ptr] = embed
+            self.valid[buffers, ptr] = True
+            self.ptr[buffers] = (ptr + 1) % self.bank.shape[1]
+        else:
+            self.bank = self.bank.index_put((buffers, ptr), embed)
+            self.valid = self.valid.index_put((buffers, ptr), torch.ones_like(ptr, dtype=torch.bool))
+            self.ptr = self.ptr.index_put((buffers, ), (ptr + 1) % self.bank.shape[1])
+
+    def read(self, buffers: Tensor):
+        """
+        Returns the [n, mem_len, dim] embeddings of `buffers` from the oldest to the newest and their padding
+        mask, in the layout of a bank shifted left at every write.
+        """
+        mem_len = self.bank.shape[1]
+        slots = (self.ptr[buffers, None] + torch.arange(mem_len, device=buffers.device)) % mem_len
+        return self.bank[buffers[:, None], slots], ~self.valid[buffers[:, None], slots]
+
+
 class MemoryBank(nn.Module):
     def __init__(self, args, dim_in, hidden_dim, dim_out):
         super().__init__()
@@ -45,30 +130,27 @@ class MemoryBank(nn.Module):
             self.spatial_attn = None
 
     def update(self, track_instances):
-        embed = track_instances.output_embedding[:, None]  #( N, 1, 256)
+        embed = track_instances.output_embedding
         scores = track_instances.scores
-        mem_padding_mask = track_instances.mem_padding_mask
-        device = embed.device
 
         save_period = track_instances.save_period
         if self.training:
             saved_idxes = scores > 0
         else:
-            saved_idxes = (save_period == 0) & (scores > self.save_thresh)
+            # only the tracks keep their bank to the next frame.
+            saved_idxes = (save_period == 0) & (scores > self.save_thresh) & (track_instances.obj_idxes >= 0)
             # saved_idxes = (save_period == 0)
             save_period[save_period > 0] -= 1
             save_period[saved_idxes] = self.save_period
 
-        saved_embed = embed[saved_idxes]
-        if len(saved_embed) > 0:
-            prev_embed = track_instances.mem_bank[saved_idxes]
-            save_embed = self.save_proj(saved_embed)
-            mem_padding_mask[saved_idxes] = torch.cat([mem_padding_mask[saved_idxes, 1:], torch.zeros((len(saved_embed), 1), dtype=torch.bool, device=device)], dim=1)
-            track_instances.mem_bank = track_instances.mem_bank.clone()
-            track_instances.mem_bank[saved_idxes] = torch.cat([prev_embed[:, 1:], save_embed], dim=1)
+        rows = torch.nonzero(saved_idxes)[:, 0]
+        memory = track_instances.mem_bank.allocate(rows)
+        # the bank is written in place at inference, autograd needs new tensors.
+        memory.write(memory.index[rows], self.save_proj(embed[rows]), inplace=not self.training)
+        track_instances.mem_bank = memory
 
     def _forward_spatial_attn(self, track_instances):
-        if len(track_instances) == 0:
+        if not torch.jit.is_tracing() and len(track_instances) == 0:
             return track_instances
 
         embed = track_instances.output_embedding
@@ -92,18 +174,19 @@ class MemoryBank(nn.Module):
         return track_instances
 
     def _forward_temporal_attn(self, track_instances):
-        if len(track_instances) == 0:
+        # a traced step keeps the general paths, they also handle no track and no saved row.
+        if not torch.jit.is_tracing() and len(track_instances) == 0:
             return track_instances
 
         dim = track_instances.query_pos.shape[1]
-        key_padding_mask = track_instances.mem_padding_mask
+        memory = track_instances.mem_bank
 
-        valid_idxes = key_padding_mask[:, -1] == 0
+        # a row has a buffer once it has been saved into.
+        valid_idxes = memory.index >= 0
         embed = track_instances.output_embedding[valid_idxes]  # (n, 256)
 
-        if len(embed) > 0:
-            prev_embed = track_instances.mem_bank[valid_idxes]
-            key_padding_mask = key_padding_mask[valid_idxes]
+        if torch.jit.is_tracing() or len(embed) > 0:
+            prev_embed, key_padding_mask = memory.read(memory.index[valid_idxes])
             embed2 = self.temporal_attn(
                 embed[None],                  # (num_track, dim) to (1, num_track, dim)
                 prev_embed.transpose(0, 1),   # (num_track, mem_len, dim) to (mem_len, num_track, dim)
@@ -20,19 +20,21 @@ from torch import nn, Tensor
 from typing import List
 
 from util import box_ops, checkpoint
+from util.cache import ShapeCache, mask_key, set_mask_key
 from util.misc import (NestedTensor, nested_tensor_from_tensor_list,
                        accuracy, get_world_size, interpolate, get_rank,
                        is_dist_avail_and_initialized, inverse_sigmoid)
 
-from models.structures import Instances, Boxes, pairwise_iou, matched_boxlist_iou
+from models.structures import Instances, Boxes, TrackSlots, pairwise_iou, matched_boxlist_iou
 
 from .backbone import build_backbone
 from .matcher import build_matcher
 from .deformable_transformer_plus import build_deforamble_transformer
 from .qim import build as build_query_interaction_layer
-from .memory_bank import build_memory_bank
+from .memory_bank import build_memory_bank, TrackMemory
 from .deformable_detr import SetCriterion, MLP
 from .segmentation import sigmoid_focal_loss
+from util.tool import load_model
 
 
 class ClipMatcher(SetCriterion):
@@ -172,6 +174,19 @@ class ClipMatcher(SetCriterion):
 
         return losses
 
+    def loss_distill(self, outputs, teacher_outputs):
+        """
+        Distillation of the predictions of a teacher for the same queries: its scores are the soft targets of
+        the focal loss of every query, its boxes the targets of the L1 loss weighted by its score.
+        """
+        src_logits = outputs['pred_logits']
+        target_scores = teacher_outputs['pred_logits'].sigmoid()
+        loss_ce = sigmoid_focal_loss(src_logits.flatten(1), target_scores.flatten(1), alpha=0.25, gamma=2,
+                                     num_boxes=1, mean_in_dim1=False)
+        weights = target_scores.max(dim=-1, keepdim=True).values
+        loss_bbox = (weights * F.l1_loss(outputs['pred_boxes'], teacher_outputs['pred_boxes'], reduction='none')).sum()
+        return {'loss_ce': loss_ce, 'loss_bbox': loss_bbox}
+
     def match_for_single_frame(self, outputs: dict):
         outputs_without_aux = {k: v for k, v in outputs.items() if k != 'aux_outputs'}
 
@@ -268,6 +283,30 @@ class ClipMatcher(SetCriterion):
             self.losses_dict.update(
                 {'frame_{}_{}'.format(self._current_frame_idx, key): value for key, value in new_track_loss.items()})
 
+        if 'enc_outputs' in outputs:
+            # the encoder proposals are matched to all the objects, regardless of their class and track.
+            enc_outputs = outputs['enc_outputs']
+            bin_gt_instances = gt_instances_i[torch.arange(len(gt_instances_i))]
+            bin_gt_instances.labels = torch.zeros_like(bin_gt_instances.labels)
+            enc_indices = self.matcher(enc_outputs, [bin_gt_instances])
+            for loss in self.losses:
+                l_dict = self.get_loss(loss,
+                                       enc_outputs,
+                                       gt_instances=[bin_gt_instances],
+                                       indices=enc_indices,
+                                       num_boxes=1, )
+                self.losses_dict.update(
+                    {'frame_{}_enc_{}'.format(self._current_frame_idx, key): value for key, value in
+                     l_dict.items()})
+
+        if 'distill_outputs' in outputs:
+            student_outputs = outputs.get('aux_outputs', []) + [outputs]
+            for i, (student_outputs_i, teacher_outputs_i) in enumerate(zip(student_outputs, outputs['distill_outputs'])):
+                l_dict = self.loss_distill(student_outputs_i, teacher_outputs_i)
+                self.losses_dict.update(
+                    {'frame_{}_distill{}_{}'.format(self._current_frame_idx, i, key): value for key, value in
+                     l_dict.items()})
+
         if 'aux_outputs' in outputs:
             for i, aux_outputs in enumerate(outputs['aux_outputs']):
                 unmatched_outputs_layer = {
@@ -311,18 +350,24 @@ class RuntimeTrackerBase(object):
         self.max_obj_id = 0
 
     def update(self, track_instances: Instances):
-        track_instances.disappear_time[track_instances.scores >= self.score_thresh] = 0
-        for i in range(len(track_instances)):
-            if track_instances.obj_idxes[i] == -1 and track_instances.scores[i] >= self.score_thresh:
-                # print("track {} has score {}, assign obj_id {}".format(i, track_instances.scores[i], self.max_obj_id))
-                track_instances.obj_idxes[i] = self.max_obj_id
-                self.max_obj_id += 1
-            elif track_instances.obj_idxes[i] >= 0 and track_instances.scores[i] < self.filter_score_thresh:
-                track_instances.disappear_time[i] += 1
-                if track_instances.disappear_time[i] >= self.miss_tolerance:
-                    # Set the obj_id to -1.
-                    # Then this track will be removed by TrackEmbeddingLayer.
-                    track_instances.obj_idxes[i] = -1
+        # masks only, so that there is no device sync per query.
+        # max_obj_id becomes a tensor on the device of the tracks.
+        scores = track_instances.scores
+        obj_idxes = track_instances.obj_idxes
+        disappear_time = track_instances.disappear_time
+        new_mask = (obj_idxes == -1) & (scores >= self.score_thresh)
+        miss_mask = (obj_idxes >= 0) & (scores < self.filter_score_thresh)
+
+        disappear_time.masked_fill_(scores >= self.score_thresh, 0)
+        # new tracks are assigned consecutive obj_ids in query order.
+        new_obj_idxes = self.max_obj_id + new_mask.cumsum(0) - 1
+        obj_idxes.copy_(torch.where(new_mask, new_obj_idxes, obj_idxes))
+        self.max_obj_id = self.max_obj_id + new_mask.sum()
+
+        disappear_time.add_(miss_mask.to(disappear_time.dtype))
+        # Set the obj_id to -1.
+        # Then this track will be removed by TrackEmbeddingLayer.
+        obj_idxes.masked_fill_(miss_mask & (disappear_time >= self.miss_tolerance), -1)
 
 
 class TrackerPostProcess(nn.Module):
@@ -367,7 +412,8 @@ def _get_clones(module, N):
 
 class MOTR(nn.Module):
     def __init__(self, backbone, transformer, num_classes, num_queries, num_feature_levels, criterion, track_embed,
-                 aux_loss=True, with_box_refine=False, two_stage=False, memory_bank=None, use_checkpoint=False):
+                 aux_loss=True, with_box_refine=False, two_stage=False, memory_bank=None, use_checkpoint=False,
+                 max_tracks=0, detect_prune_layer=0, detect_prune_thresh=0.05, eval_dec_layers=0, teacher=None):
         """ Initializes the model.
         Parameters:
             backbone: torch module of the backbone to be used. See backbone.py
@@ -378,6 +424,14 @@ class MOTR(nn.Module):
             aux_loss: True if auxiliary decoding losses (loss at each decoder layer) are to be used.
             with_box_refine: iterative bounding box refinement
             two_stage: two-stage Deformable DETR
+            max_tracks: track slots of the fixed-capacity track store used at inference, 0 to rebuild
+                        the track instances every frame.
+            detect_prune_layer: at inference, the decoder layers after the first detect_prune_layer ones only run
+                                on the detect queries scoring at least detect_prune_thresh and the track queries,
+                                0 to run all the layers on all the queries.
+            eval_dec_layers: number of decoder layers run at inference, predicting with the heads of the last one,
+                             0 for all of them.
+            teacher: eval-mode MOTR whose decoder layers are distilled into the ones of this model in training.
         """
         super().__init__()
         self.num_queries = num_queries
@@ -450,13 +504,55 @@ class MOTR(nn.Module):
         self.criterion = criterion
         self.memory_bank = memory_bank
         self.mem_bank_len = 0 if memory_bank is None else memory_bank.max_his_length
+        self.max_tracks = max_tracks
+        self.detect_prune_layer = detect_prune_layer
+        self.detect_prune_thresh = detect_prune_thresh
+        self.eval_dec_layers = eval_dec_layers
+        # not a submodule: the teacher is neither trained nor saved with the model.
+        object.__setattr__(self, 'teacher', teacher)
+        self._level_mask_cache = ShapeCache()
+        # (key, detect queries) of the last eval-mode template, see _generate_empty_tracks.
+        self._empty_tracks_cache = None
+
+    def _empty_tracks_key(self):
+        if self.two_stage:
+            weight = self.class_embed[0].weight
+            params = []
+        else:
+            weight = self.query_embed.weight
+            params = [self.query_embed.weight] + list(self.transformer.reference_points.parameters())
+        return tuple((p.data_ptr(), p._version) for p in params) + (weight.device, weight.dtype)
 
     def _generate_empty_tracks(self):
+        """
+        Returns the track instances of the detect queries.
+        At inference the template is built once per version of the weights, the fields updated in place by
+        the track base and the memory bank are copied, the others are shared with the template.
+        """
+        if self.training or torch.is_grad_enabled() or torch.jit.is_tracing():
+            return self._build_empty_tracks()
+        key = self._empty_tracks_key()
+        if self._empty_tracks_cache is None or self._empty_tracks_cache[0] != key:
+            self._empty_tracks_cache = (key, self._build_empty_tracks())
+        template = self._empty_tracks_cache[1]
+        track_instances = Instances(template.image_size)
+        for k, v in template.get_fields().items():
+            track_instances.set(k, v.clone() if k in ('obj_idxes', 'disappear_time', 'save_period') else v)
+        return track_instances
+
+    def _build_empty_tracks(self):
         track_instances = Instances((1, 1))
-        num_queries, dim = self.query_embed.weight.shape  # (300, 512)
-        device = self.query_embed.weight.device
-        track_instances.ref_pts = self.transformer.reference_points(self.query_embed.weight[:, :dim // 2])
-        track_instances.query_pos = self.query_embed.weight
+        if self.two_stage:
+            # placeholders, the detect queries of every frame are proposed by the encoder, see _propose_detect_queries.
+            num_queries, dim = self.num_queries, self.transformer.d_model * 2
+            device = self.class_embed[0].weight.device
+            track_instances.ref_pts = torch.zeros((num_queries, 2), device=device)
+            track_instances.query_pos = torch.zeros((num_queries, dim), device=device)
+        else:
+            num_queries, dim = self.query_embed.weight.shape  # (300, 512)
+            device = self.query_embed.weight.device
+            track_instances.ref_pts = self.transformer.reference_points(self.query_embed.weight[:, :dim // 2])
+            track_instances.query_pos = self.query_embed.weight
         track_instances.output_embedding = torch.zeros((num_queries, dim >> 1), device=device)
         track_instances.obj_idxes = torch.full((len(track_instances),), -1, dtype=torch.long, device=device)
         track_instances.matched_gt_idxes = torch.full((len(track_instances),), -1, dtype=torch.long, device=device)
@@ -467,16 +563,38 @@ class MOTR(nn.Module):
         track_instances.pred_boxes = torch.zeros((len(track_instances), 4), dtype=torch.float, device=device)
         track_instances.pred_logits = torch.zeros((len(track_instances), self.num_classes), dtype=torch.float, device=device)
 
-        mem_bank_len = self.mem_bank_len
-        track_instances.mem_bank = torch.zeros((len(track_instances), mem_bank_len, dim // 2), dtype=torch.float32, device=device)
-        track_instances.mem_padding_mask = torch.ones((len(track_instances), mem_bank_len), dtype=torch.bool, device=device)
+        # the banks are allocated when the rows are saved into.
+        track_instances.mem_bank = TrackMemory.empty(len(track_instances), self.mem_bank_len, dim // 2, device)
         track_instances.save_period = torch.zeros((len(track_instances), ), dtype=torch.float32, device=device)
 
-        return track_instances.to(self.query_embed.weight.device)
+        return track_instances.to(device)
+
+    @property
+    def track_state_fields(self):
+        """Fields of the track instances carried to the next frame, all the others are rewritten by every frame."""
+        fields = ['query_pos', 'ref_pts', 'obj_idxes', 'disappear_time']
+        if self.memory_bank is not None:
+            fields += ['mem_bank', 'save_period']
+        return fields
+
+    def _generate_initial_tracks(self):
+        if self.max_tracks > 0:
+            slots = TrackSlots(self._generate_empty_tracks(), self.track_state_fields, ['pred_logits', 'pred_boxes'],
+                               self.max_tracks)
+            return slots.packed()
+        return self._generate_empty_tracks()
 
     def clear(self):
         self.track_base.clear()
 
+    def train(self, mode=True):
+        self._empty_tracks_cache = None
+        return super().train(mode)
+
+    def load_state_dict(self, *args, **kwargs):
+        self._empty_tracks_cache = None
+        return super().load_state_dict(*args, **kwargs)
+
     @torch.jit.unused
     def _set_aux_loss(self, outputs_class, outputs_coord):
         # this is a workaround to make torchscript happy, as torchscript
@@ -485,7 +603,11 @@ class MOTR(nn.Module):
         return [{'pred_logits': a, 'pred_boxes': b, }
                 for a, b in zip(outputs_class[:-1], outputs_coord[:-1])]
 
-    def _forward_single_image(self, samples, track_instances: Instances):
+    def _encode_images(self, samples: NestedTensor):
+        """
+        Backbone, input projections and transformer encoder. Every image of the batch is
+        encoded independently, so the batch may mix frames of different sequences.
+        """
         features, pos = self.backbone(samples)
         src, mask = features[-1].decompose()
         assert mask is not None
@@ -506,43 +628,147 @@ class MOTR(nn.Module):
                 else:
                     src = self.input_proj[l](srcs[-1])
                 m = samples.mask
-                mask = F.interpolate(m[None].float(), size=src.shape[-2:]).to(torch.bool)[0]
+                level_key = (mask_key(m), tuple(src.shape[-2:]))
+                mask = self._level_mask_cache(level_key, lambda: set_mask_key(
+                    F.interpolate(m[None].float(), size=src.shape[-2:]).to(torch.bool)[0], level_key),
+                    enabled=not self.training)
                 pos_l = self.backbone[1](NestedTensor(src, mask)).to(src.dtype)
                 srcs.append(src)
                 masks.append(mask)
                 pos.append(pos_l)
 
-        hs, init_reference, inter_references, enc_outputs_class, enc_outputs_coord_unact = self.transformer(srcs, masks, pos, track_instances.query_pos, ref_pts=track_instances.ref_pts)
+        return self.transformer.encode(srcs, masks, pos)
+
+    @staticmethod
+    def _select_encoded(encoded, idx):
+        """Picks the encoder outputs of the `idx`-th image of a batch."""
+        selected = dict(encoded)
+        for k in ('memory', 'mask_flatten', 'valid_ratios'):
+            selected[k] = encoded[k][idx:idx + 1]
+        return selected
+
+    def _predict(self, head, hs, reference):
+        """Class logits and boxes of the `head`-th heads, from decoder outputs and the reference points given to their layer."""
+        reference = inverse_sigmoid(reference)
+        outputs_class = self.class_embed[head](hs)
+        tmp = self.bbox_embed[head](hs)
+        if reference.shape[-1] == 4:
+            tmp += reference
+        else:
+            assert reference.shape[-1] == 2
+            tmp[..., :2] += reference
+        return outputs_class, tmp.sigmoid()
+
+    def _detect_query_filter(self, pruned: dict):
+        """
+        Decoder query filter dropping, after the first detect_prune_layer layers, the detect queries whose score is
+        below detect_prune_thresh. The predictions of all the queries at that layer are stored into `pruned`,
+        the dropped ones keep them as their outputs.
+        """
+        num_detect = self.num_queries
+
+        def query_filter(lid, output, reference):
+            if lid != self.detect_prune_layer - 1:
+                return None
+            outputs_class, outputs_coord = self._predict(lid, output, reference)
+            scores = outputs_class[:, :num_detect].sigmoid().max(dim=-1).values.max(dim=0).values
+            keep = torch.cat([torch.nonzero(scores >= self.detect_prune_thresh)[:, 0],
+                              torch.arange(num_detect, output.shape[1], device=output.device)])
+            pruned.update(keep=keep, hs=output, reference=reference, pred_logits=outputs_class, pred_boxes=outputs_coord)
+            return keep
+        return query_filter
+
+    def _propose_detect_queries(self, encoded, track_instances: Instances):
+        """
+        Two-stage: replaces the placeholder detect queries by the top num_queries proposals of the encoder,
+        referenced at the center of their box. Returns the encoder predictions supervised in training, None otherwise.
+        """
+        query_pos, coords_unact, enc_outputs_class, enc_outputs_coord_unact = self.transformer.propose(
+            encoded, self.num_queries, all_boxes=self.training)
+        track_instances.query_pos = torch.cat([query_pos[0], track_instances.query_pos[self.num_queries:]])
+        track_instances.ref_pts = torch.cat([coords_unact[0, :, :2], track_instances.ref_pts[self.num_queries:]])
+        if not self.training:
+            return None
+        return {'pred_logits': enc_outputs_class, 'pred_boxes': enc_outputs_coord_unact.sigmoid()}
+
+    def _decode_single_image(self, encoded, track_instances: Instances, last_layer_only=None):
+        # inference only reads the last decoder layer, the others are needed by the auxiliary losses.
+        if last_layer_only is None:
+            last_layer_only = not self.training
+        num_layers = self.transformer.decoder.num_layers
+        if last_layer_only and self.eval_dec_layers > 0:
+            num_layers = min(self.eval_dec_layers, num_layers)
+        if self.two_stage:
+            enc_outputs = self._propose_detect_queries(encoded, track_instances)
+        pruned = {}
+        query_filter = None
+        if last_layer_only and 0 < self.detect_prune_layer < num_layers and not torch.jit.is_tracing():
+            query_filter = self._detect_query_filter(pruned)
+        hs, init_reference, inter_references, enc_outputs_class, enc_outputs_coord_unact = self.transformer.decode(
+            encoded, track_instances.query_pos, ref_pts=track_instances.ref_pts, last_layer_only=last_layer_only,
+            query_filter=query_filter, num_layers=num_layers)
 
         outputs_classes = []
         outputs_coords = []
         for lvl in range(hs.shape[0]):
-            if lvl == 0:
-                reference = init_reference
-            else:
-                reference = inter_references[lvl - 1]
-            reference = inverse_sigmoid(reference)
-            outputs_class = self.class_embed[lvl](hs[lvl])
-            tmp = self.bbox_embed[lvl](hs[lvl])
-            if reference.shape[-1] == 4:
-                tmp += reference
+            if last_layer_only:
+                reference = inter_references[0]
+                head = num_layers - 1
             else:
-                assert reference.shape[-1] == 2
-                tmp[..., :2] += reference
-            outputs_coord = tmp.sigmoid()
+                reference = init_reference if lvl == 0 else inter_references[lvl - 1]
+                head = lvl
+            outputs_class, outputs_coord = self._predict(head, hs[lvl], reference)
             outputs_classes.append(outputs_class)
             outputs_coords.append(outputs_coord)
         outputs_class = torch.stack(outputs_classes)
         outputs_coord = torch.stack(outputs_coords)
 
-        ref_pts_all = torch.cat([init_reference[None], inter_references[:, :, :, :2]], dim=0)
-        out = {'pred_logits': outputs_class[-1], 'pred_boxes': outputs_coord[-1], 'ref_pts': ref_pts_all[5]}
-        if self.aux_loss:
+        if last_layer_only:
+            ref_pts = inter_references[0][..., :2]
+        else:
+            ref_pts_all = torch.cat([init_reference[None], inter_references[:, :, :, :2]], dim=0)
+            ref_pts = ref_pts_all[num_layers - 1]
+        if pruned:
+            # scatter the kept queries back among the dropped ones, which keep their outputs of the pruning layer.
+            def scatter(dropped, kept):
+                out = dropped.clone()
+                out[:, pruned['keep']] = kept
+                return out
+            outputs_class = scatter(pruned['pred_logits'], outputs_class[-1])[None]
+            outputs_coord = scatter(pruned['pred_boxes'], outputs_coord[-1])[None]
+            ref_pts = scatter(pruned['reference'][..., :2], ref_pts)
+            hs = scatter(pruned['hs'], hs[-1])[None]
+        out = {'pred_logits': outputs_class[-1], 'pred_boxes': outputs_coord[-1], 'ref_pts': ref_pts}
+        if self.aux_loss and not last_layer_only:
             out['aux_outputs'] = self._set_aux_loss(outputs_class, outputs_coord)
+        if self.two_stage and self.training:
+            out['enc_outputs'] = enc_outputs
         out['hs'] = hs[-1]
         return out
+
+    @torch.no_grad()
+    def _teacher_outputs(self, samples, track_instances: Instances):
+        """
+        Predictions of the teacher for the queries of this model, one per decoder layer of this model
+        (or only for the last one without aux_loss), taken from evenly spaced layers of the teacher.
+        """
+        teacher = self.teacher
+        queries = Instances((1, 1), query_pos=track_instances.query_pos.detach(), ref_pts=track_instances.ref_pts.detach())
+        res = teacher._decode_single_image(teacher._encode_images(samples), queries, last_layer_only=False)
+        teacher_outputs = [{'pred_logits': aux['pred_logits'], 'pred_boxes': aux['pred_boxes']}
+                           for aux in res.get('aux_outputs', [])]
+        teacher_outputs.append({'pred_logits': res['pred_logits'], 'pred_boxes': res['pred_boxes']})
+        num_layers, num_teacher_layers = self.transformer.decoder.num_layers, len(teacher_outputs)
+        layers = [(i + 1) * num_teacher_layers // num_layers - 1 for i in range(num_layers)]
+        if not self.aux_loss:
+            layers = layers[-1:]
+        return [teacher_outputs[i] for i in layers]
+
+    def _forward_single_image(self, samples, track_instances: Instances):
+        encoded = self._encode_images(samples)
+        return self._decode_single_image(encoded, track_instances)
     
-    def _post_process_single_image(self, frame_res, track_instances, is_last):
+    def _post_process_single_image(self, frame_res, track_instances, is_last, track_base=None):
         with torch.no_grad():
             if self.training:
                 track_scores = frame_res['pred_logits'][0, :].sigmoid().max(dim=-1).values
@@ -559,7 +785,9 @@ class MOTR(nn.Module):
             track_instances = self.criterion.match_for_single_frame(frame_res)
         else:
             # each track will be assigned an unique global id by the track base.
-            self.track_base.update(track_instances)
+            if track_base is None:
+                track_base = self.track_base
+            track_base.update(track_instances)
         if self.memory_bank is not None:
             track_instances = self.memory_bank(track_instances)
             # track_instances.track_scores = track_instances.track_scores[..., 0]
@@ -567,8 +795,11 @@ class MOTR(nn.Module):
             if self.training:
                 self.criterion.calc_loss_for_track_scores(track_instances)
         tmp = {}
-        tmp['init_track_instances'] = self._generate_empty_tracks()
         tmp['track_instances'] = track_instances
+        # instances packed from a TrackSlots are updated in their slots, without the detect queries.
+        tmp['track_slots'] = getattr(track_instances, '_slots', None)
+        if tmp['track_slots'] is None:
+            tmp['init_track_instances'] = self._generate_empty_tracks()
         if not is_last:
             out_track_instances = self.track_embed(tmp)
             frame_res['track_instances'] = out_track_instances
@@ -576,16 +807,7 @@ class MOTR(nn.Module):
             frame_res['track_instances'] = None
         return frame_res
 
-    @torch.no_grad()
-    def inference_single_image(self, img, ori_img_size, track_instances=None):
-        if not isinstance(img, NestedTensor):
-            img = nested_tensor_from_tensor_list(img)
-        if track_instances is None:
-            track_instances = self._generate_empty_tracks()
-        res = self._forward_single_image(img,
-                                         track_instances=track_instances)
-        res = self._post_process_single_image(res, track_instances, False)
-
+    def _finalize_inference(self, res, ori_img_size):
         track_instances = res['track_instances']
         track_instances = self.post_process(track_instances, ori_img_size)
         ret = {'track_instances': track_instances}
@@ -597,6 +819,67 @@ class MOTR(nn.Module):
             ret['ref_pts'] = ref_pts
         return ret
 
+    @torch.no_grad()
+    def encode_frame(self, img):
+        """
+        Stateless half of inference_single_image: backbone, input projections and encoder of a frame.
+        It does not depend on the tracks, so it can run ahead of track_encoded_frame on another thread.
+        """
+        if not isinstance(img, NestedTensor):
+            img = nested_tensor_from_tensor_list(img)
+        return self._encode_images(img)
+
+    @torch.no_grad()
+    def encode_frames(self, imgs):
+        """
+        encode_frame of several frames in one batch, e.g. the next frames of a sequence.
+        Returns the outputs of every frame, which keep the ones of the whole batch alive.
+        """
+        if not isinstance(imgs, NestedTensor):
+            imgs = nested_tensor_from_tensor_list(imgs)
+        encoded = self._encode_images(imgs)
+        return [self._select_encoded(encoded, i) for i in range(len(imgs.tensors))]
+
+    @torch.no_grad()
+    def track_encoded_frame(self, encoded, ori_img_size, track_instances=None):
+        """Stateful half of inference_single_image: decoder and track update on the output of encode_frame."""
+        if track_instances is None:
+            track_instances = self._generate_initial_tracks()
+        res = self._decode_single_image(encoded, track_instances)
+        res = self._post_process_single_image(res, track_instances, False)
+        return self._finalize_inference(res, ori_img_size)
+
+    @torch.no_grad()
+    def inference_single_image(self, img, ori_img_size, track_instances=None):
+        return self.track_encoded_frame(self.encode_frame(img), ori_img_size, track_instances)
+
+    @torch.no_grad()
+    def inference_multi_image(self, imgs, ori_img_sizes, track_instances_list, track_bases):
+        """
+        Advances several independent sequences by one frame each.
+        The frames share a single backbone and encoder pass, the decoder and the track
+        bookkeeping run per sequence.
+        Parameters:
+            imgs: list of [3, H, W] tensors (one frame per sequence) or a batched NestedTensor.
+            ori_img_sizes: list of (h, w) original frame sizes.
+            track_instances_list: list of the track instances returned for the previous frame
+                of every sequence, None for the first frame of a sequence.
+            track_bases: list of RuntimeTrackerBase, one per sequence.
+        Returns:
+            list of dicts, the same as inference_single_image, in the order of the inputs.
+        """
+        if not isinstance(imgs, NestedTensor):
+            imgs = nested_tensor_from_tensor_list(imgs)
+        encoded = self._encode_images(imgs)
+        rets = []
+        for i, (ori_img_size, track_instances, track_base) in enumerate(zip(ori_img_sizes, track_instances_list, track_bases)):
+            if track_instances is None:
+                track_instances = self._generate_initial_tracks()
+            res = self._decode_single_image(self._select_encoded(encoded, i), track_instances)
+            res = self._post_process_single_image(res, track_instances, False, track_base=track_base)
+            rets.append(self._finalize_inference(res, ori_img_size))
+        return rets
+
     def forward(self, data: dict):
         if self.training:
             self.criterion.initialize_for_single_clip(data['gt_instances'])
@@ -607,16 +890,19 @@ class MOTR(nn.Module):
         }
 
         track_instances = self._generate_empty_tracks()
-        keys = list(track_instances._fields.keys())
+        # the memory bank is not a tensor and is not read by _forward_single_image.
+        keys = [k for k, v in track_instances.get_fields().items() if isinstance(v, torch.Tensor)]
         for frame_index, frame in enumerate(frames):
             frame.requires_grad = False
             is_last = frame_index == len(frames) - 1
+            if self.training and self.teacher is not None:
+                distill_outputs = self._teacher_outputs(nested_tensor_from_tensor_list([frame]), track_instances)
             if self.use_checkpoint and frame_index < len(frames) - 2:
                 def fn(frame, *args):
                     frame = nested_tensor_from_tensor_list([frame])
                     tmp = Instances((1, 1), **dict(zip(keys, args)))
                     frame_res = self._forward_single_image(frame, tmp)
-                    return (
+                    outs = (
                         frame_res['pred_logits'],
                         frame_res['pred_boxes'],
                         frame_res['ref_pts'],
@@ -624,8 +910,14 @@ class MOTR(nn.Module):
                         *[aux['pred_logits'] for aux in frame_res['aux_outputs']],
                         *[aux['pred_boxes'] for aux in frame_res['aux_outputs']]
                     )
+                    if self.two_stage:
+                        # the proposed detect queries are set on tmp.
+                        outs += (tmp.query_pos, tmp.ref_pts,
+                                 frame_res['enc_outputs']['pred_logits'], frame_res['enc_outputs']['pred_boxes'])
+                    return outs
 
                 args = [frame] + [track_instances.get(k) for k in keys]
+                num_aux = self.transformer.decoder.num_layers - 1
                 params = tuple((p for p in self.parameters() if p.requires_grad))
                 tmp = checkpoint.CheckpointFunction.apply(fn, len(args), *args, *params)
                 frame_res = {
@@ -635,12 +927,17 @@ class MOTR(nn.Module):
                     'hs': tmp[3],
                     'aux_outputs': [{
                         'pred_logits': tmp[4+i],
-                        'pred_boxes': tmp[4+5+i],
-                    } for i in range(5)],
+                        'pred_boxes': tmp[4+num_aux+i],
+                    } for i in range(num_aux)],
                 }
+                if self.two_stage:
+                    track_instances.query_pos, track_instances.ref_pts = tmp[-4], tmp[-3]
+                    frame_res['enc_outputs'] = {'pred_logits': tmp[-2], 'pred_boxes': tmp[-1]}
             else:
                 frame = nested_tensor_from_tensor_list([frame])
                 frame_res = self._forward_single_image(frame, track_instances)
+            if self.training and self.teacher is not None:
+                frame_res['distill_outputs'] = distill_outputs
             frame_res = self._post_process_single_image(frame_res, track_instances, is_last)
 
             track_instances = frame_res['track_instances']
@@ -691,6 +988,19 @@ def build(args):
                                     'frame_{}_aux{}_loss_bbox'.format(i, j): args.bbox_loss_coef,
                                     'frame_{}_aux{}_loss_giou'.format(i, j): args.giou_loss_coef,
                                     })
+    if args.distill_teacher:
+        num_distill = args.dec_layers if args.aux_loss else 1
+        for i in range(num_frames_per_batch):
+            for j in range(num_distill):
+                weight_dict.update({"frame_{}_distill{}_loss_ce".format(i, j): args.distill_loss_coef * args.cls_loss_coef,
+                                    'frame_{}_distill{}_loss_bbox'.format(i, j): args.distill_loss_coef * args.bbox_loss_coef,
+                                    })
+    if args.two_stage:
+        for i in range(num_frames_per_batch):
+            weight_dict.update({"frame_{}_enc_loss_ce".format(i): args.cls_loss_coef,
+                                'frame_{}_enc_loss_bbox'.format(i): args.bbox_loss_coef,
+                                'frame_{}_enc_loss_giou'.format(i): args.giou_loss_coef,
+                                })
     if args.memory_bank_type is not None and len(args.memory_bank_type) > 0:
         memory_bank = build_memory_bank(args, d_model, hidden_dim, d_model * 2)
         for i in range(num_frames_per_batch):
@@ -701,6 +1011,17 @@ def build(args):
     criterion = ClipMatcher(num_classes, matcher=img_matcher, weight_dict=weight_dict, losses=losses)
     criterion.to(device)
     postprocessors = {}
+    teacher = None
+    if args.distill_teacher:
+        assert not args.two_stage, 'the two-stage detect queries of the teacher would differ from the ones of the student.'
+        teacher_args = copy.copy(args)
+        teacher_args.dec_layers = args.teacher_dec_layers
+        teacher_args.distill_teacher = ''
+        teacher, _, _ = build(teacher_args)
+        teacher = load_model(teacher, args.distill_teacher)
+        teacher.eval()
+        teacher.requires_grad_(False)
+        teacher.to(device)
     model = MOTR(
         backbone,
         transformer,
@@ -714,5 +1035,10 @@ def build(args):
         two_stage=args.two_stage,
         memory_bank=memory_bank,
         use_checkpoint=args.use_checkpoint,
+        max_tracks=args.max_tracks,
+        detect_prune_layer=args.detect_prune_layer,
+        detect_prune_thresh=args.detect_prune_thresh,
+        eval_dec_layers=args.eval_dec_layers,
+        teacher=teacher,
     )
     return model, criterion, postprocessors
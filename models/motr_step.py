@@ -0,0 +1,111 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+"""
+Per-frame tracking step of MOTR with the track state as a fixed tuple of tensors,
+so that it can be exported with torch.jit.trace.
+"""
+import copy
+from typing import Tuple
+
+import torch
+from torch import nn, Tensor
+
+from util.misc import NestedTensor
+from models.structures import Instances
+from models.memory_bank import TrackMemory
+
+
+class MOTRStep(nn.Module):
+    """
+    step(img, ori_img_size, state) -> (outputs, new_state) of an eval-mode MOTR.
+
+    img is the normalized [1, 3, H, W] frame and ori_img_size the (h, w) of the original frame as a float tensor.
+    state holds the fields in `state_fields` of the detect queries and the active tracks, with the memory bank
+    as its four tensors, followed by the 0-dim id counter of the track base. outputs are (boxes, scores, labels, obj_idxes, ref_pts) of the detect queries
+    and the active tracks, like the track instances returned by MOTR.inference_single_image.
+    """
+    def __init__(self, model):
+        super().__init__()
+        assert not model.training
+        self.model = model
+        self.track_base = copy.copy(model.track_base)
+        self.state_fields = model.track_state_fields
+
+    def _flatten_state(self, track_instances):
+        state = []
+        for k in self.state_fields:
+            v = track_instances.get(k)
+            state.extend(v.tensors() if isinstance(v, TrackMemory) else (v, ))
+        return tuple(state)
+
+    def _unflatten_state(self, state):
+        fields = {}
+        i = 0
+        for k in self.state_fields:
+            if k == 'mem_bank':
+                fields[k] = TrackMemory(*state[i:i + 4])
+                i += 4
+            else:
+                fields[k] = state[i]
+                i += 1
+        return fields
+
+    def initial_state(self) -> Tuple[Tensor, ...]:
+        track_instances = self.model._generate_empty_tracks()
+        max_obj_id = torch.zeros((), dtype=torch.long, device=track_instances.obj_idxes.device)
+        return self._flatten_state(track_instances) + (max_obj_id, )
+
+    def _state_to_instances(self, state):
+        template = self.model._generate_empty_tracks()
+        # the track base and the memory bank update these in place.
+        fields = self._unflatten_state([v.clone() for v in state])
+        num_tracks = state[0].shape[0]
+        track_instances = Instances((1, 1))
+        for k, v in template.get_fields().items():
+            if k in fields:
+                track_instances.set(k, fields[k])
+            elif isinstance(v, TrackMemory):
+                # the bank of a model without memory bank is never saved into.
+                track_instances.set(k, TrackMemory.empty(num_tracks, v.bank.shape[1], v.bank.shape[2], v.index.device))
+            else:
+                track_instances.set(k, v.new_zeros((num_tracks, ) + v.shape[1:]))
+        return track_instances
+
+    def forward(self, img: Tensor, ori_img_size: Tensor, state: Tuple[Tensor, ...]):
+        model = self.model
+        track_instances = self._state_to_instances(state[:-1])
+        self.track_base.max_obj_id = state[-1]
+
+        # a single frame has no padding.
+        mask = torch.zeros((img.shape[0], img.shape[2], img.shape[3]), dtype=torch.bool, device=img.device)
+        res = model._forward_single_image(NestedTensor(img, mask), track_instances)
+        res = model._post_process_single_image(res, track_instances, False, track_base=self.track_base)
+        track_instances = res['track_instances']
+        new_state = self._flatten_state(track_instances) + (self.track_base.max_obj_id, )
+
+        # the same as TrackerPostProcess, with the image size as a tensor.
+        scores, labels = track_instances.pred_logits.sigmoid().max(-1)
+        cx, cy, w, h = track_instances.pred_boxes.unbind(-1)
+        boxes = torch.stack([cx - 0.5 * w, cy - 0.5 * h, cx + 0.5 * w, cy + 0.5 * h], dim=-1)
+        img_h, img_w = ori_img_size.to(boxes).unbind(0)
+        boxes = boxes * torch.stack([img_w, img_h, img_w, img_h])[None]
+        ref_pts = res['ref_pts'] * torch.stack([img_w, img_h])[None]
+        outputs = (boxes, scores, labels, track_instances.obj_idxes, ref_pts)
+        return outputs, new_state
+
+
+@torch.no_grad()
+def trace_motr_step(model, img, ori_img_size, num_warmup_frames=2):
+    """
+    Traces MOTRStep for frames of the size of `img`, the traced step only accepts that size.
+    The track paths of the decoder, QIM and the memory bank skip their shortcuts for no track while
+    tracing, so the traced step holds for any number of tracks. It is traced on the state after
+    `num_warmup_frames` steps on `img`. Returns a ScriptModule with forward and initial_state.
+    """
+    step = MOTRStep(model)
+    state = step.initial_state()
+    for _ in range(num_warmup_frames):
+        _, state = step(img, ori_img_size, state)
+    return torch.jit.trace_module(step, {'forward': (img, ori_img_size, state), 'initial_state': ()}, check_trace=False)
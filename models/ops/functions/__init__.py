@@ -9,5 +9,5 @@
 # ------------------------------------------------------------------------
 
 
-from .ms_deform_attn_func import MSDeformAttnFunction
+from .ms_deform_attn_func import MSDeformAttnFunction, ms_deform_attn, ms_deform_attn_core_pytorch, ms_deform_attn_core_gather
 
@@ -18,7 +18,11 @@ import torch.nn.functional as F
 from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 
-import MultiScaleDeformableAttention as MSDA
+try:
+    import MultiScaleDeformableAttention as MSDA
+except ImportError:
+    # the cuda extension is not built, e.g. on cpu-only machines.
+    MSDA = None
 
 
 class MSDeformAttnFunction(Function):
@@ -62,3 +66,62 @@ def ms_deform_attn_core_pytorch(value, value_spatial_shapes, sampling_locations,
     attention_weights = attention_weights.transpose(1, 2).reshape(N_*M_, 1, Lq_, L_*P_)
     output = (torch.stack(sampling_value_list, dim=-2).flatten(-2) * attention_weights).sum(-1).view(N_, M_*D_, Lq_)
     return output.transpose(1, 2).contiguous()
+
+
+def ms_deform_attn_core_gather(value, value_spatial_shapes, value_level_start_index, sampling_locations, attention_weights):
+    """
+    Pytorch implementation for devices without the cuda extension, e.g. cpu.
+    The bilinear corners of all levels, points and heads are gathered from the flattened value
+    in a single embedding_bag, weighted by attention weight * bilinear weight, and summed.
+    No per-level split / stack copies are made and the [Lq, L*P, D] sampled values are never
+    materialized. The backward (index_add into value, dot products for the weights) comes from
+    autograd through embedding_bag, so training works as well.
+    Sampling follows grid_sample(mode='bilinear', padding_mode='zeros', align_corners=False).
+    """
+    N_, S_, M_, D_ = value.shape
+    _, Lq_, M_, L_, P_, _ = sampling_locations.shape
+    idx_dtype = torch.int32 if N_ * S_ * M_ < 2 ** 31 else torch.int64
+    H_ = value_spatial_shapes[:, 0].view(1, 1, 1, L_, 1).to(idx_dtype)
+    W_ = value_spatial_shapes[:, 1].view(1, 1, 1, L_, 1).to(idx_dtype)
+    level_start = value_level_start_index.view(1, 1, 1, L_, 1).to(idx_dtype)
+
+    # N_, Lq_, M_, L_, P_ pixel coordinates of the sampling points.
+    x = sampling_locations[..., 0] * W_.to(value.dtype) - 0.5
+    y = sampling_locations[..., 1] * H_.to(value.dtype) - 0.5
+    x0 = x.floor()
+    y0 = y.floor()
+    lx = x - x0
+    ly = y - y0
+    x0 = x0.to(idx_dtype)
+    y0 = y0.to(idx_dtype)
+
+    # N_, Lq_, M_, L_, P_, 2 weights of the left/right and top/bottom neighbours, zero outside of the map.
+    # The attention weights are folded into the vertical ones.
+    wx = torch.stack([(1 - lx) * ((x0 >= 0) & (x0 < W_)), lx * ((x0 >= -1) & (x0 < W_ - 1))], dim=-1)
+    wy = torch.stack([(1 - ly) * ((y0 >= 0) & (y0 < H_)), ly * ((y0 >= -1) & (y0 < H_ - 1))], dim=-1)
+    wy = wy * attention_weights[..., None]
+    # N_, Lq_, M_, L_, P_, 4 corners: top-left, top-right, bottom-left, bottom-right.
+    weights = (wy[..., :, None] * wx[..., None, :]).flatten(-2)
+
+    # rows of value viewed as (N_ * S_ * M_, D_). Corners out of the map have weight 0,
+    # they only need to point at some existing row.
+    batch_offset = torch.arange(N_, dtype=idx_dtype, device=value.device).view(N_, 1, 1, 1, 1) * (S_ * M_)
+    head_offset = torch.arange(M_, dtype=idx_dtype, device=value.device).view(1, 1, M_, 1, 1)
+    rows = batch_offset + (level_start + y0 * W_ + x0) * M_ + head_offset
+    corner_offset = torch.stack([torch.zeros_like(W_), torch.ones_like(W_), W_, W_ + 1], dim=-1) * M_
+    rows = (rows[..., None] + corner_offset).clamp_(0, N_ * S_ * M_ - 1)
+
+    output = F.embedding_bag(rows.view(N_ * Lq_ * M_, L_ * P_ * 4), value.reshape(N_ * S_ * M_, D_),
+                             per_sample_weights=weights.view(N_ * Lq_ * M_, L_ * P_ * 4), mode='sum')
+    return output.view(N_, Lq_, M_ * D_)
+
+
+def ms_deform_attn(value, value_spatial_shapes, value_level_start_index, sampling_locations, attention_weights, im2col_step):
+    """
+    Uses the cuda extension for cuda tensors when it is built, the gather implementation otherwise.
+    Traced graphs always use the gather implementation since the extension is not a TorchScript op.
+    """
+    if MSDA is not None and value.is_cuda and not torch.jit.is_tracing():
+        return MSDeformAttnFunction.apply(
+            value, value_spatial_shapes, value_level_start_index, sampling_locations, attention_weights, im2col_step)
+    return ms_deform_attn_core_gather(value, value_spatial_shapes, value_level_start_index, sampling_locations, attention_weights)
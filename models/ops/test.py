@@ -15,12 +15,17 @@ import torch
 import torch.nn as nn
 from torch.autograd import gradcheck
 
-from functions.ms_deform_attn_func import MSDeformAttnFunction, ms_deform_attn_core_pytorch
+from functions.ms_deform_attn_func import MSDA, MSDeformAttnFunction, ms_deform_attn_core_pytorch, ms_deform_attn_core_gather
 
 
+# the cuda extension checks only run on machines where it is built.
+with_cuda = torch.cuda.is_available() and MSDA is not None
+
 N, M, D = 1, 2, 2
 Lq, L, P = 2, 2, 2
-shapes = torch.as_tensor([(6, 4), (3, 2)], dtype=torch.long).cuda()
+shapes = torch.as_tensor([(6, 4), (3, 2)], dtype=torch.long)
+if with_cuda:
+    shapes = shapes.cuda()
 level_start_index = torch.cat((shapes.new_zeros((1, )), shapes.prod(1).cumsum(0)[:-1]))
 S = sum([(H*W).item() for H, W in shapes])
 
@@ -78,12 +83,78 @@ def check_gradient_numerical(channels=4, grad_value=True, grad_sampling_loc=True
     print(f'* {gradok} check_gradient_numerical(D={channels})')
 
 
+def check_gather_equal_with_pytorch_double():
+    # sampling locations partly outside of the maps to cover the zero padding.
+    value = torch.rand(N, S, M, D, dtype=torch.double) * 0.01
+    sampling_locations = torch.rand(N, Lq, M, L, P, 2, dtype=torch.double) * 1.4 - 0.2
+    attention_weights = torch.rand(N, Lq, M, L, P, dtype=torch.double) + 1e-5
+    attention_weights /= attention_weights.sum(-1, keepdim=True).sum(-2, keepdim=True)
+    inputs = (value, sampling_locations, attention_weights)
+    for x in inputs:
+        x.requires_grad = True
+    grad_output = torch.rand(N, Lq, M * D, dtype=torch.double)
+
+    output_pytorch = ms_deform_attn_core_pytorch(value, shapes.cpu(), sampling_locations, attention_weights)
+    output_gather = ms_deform_attn_core_gather(value, shapes.cpu(), level_start_index.cpu(), sampling_locations, attention_weights)
+    fwdok = torch.allclose(output_gather, output_pytorch)
+    max_abs_err = (output_gather - output_pytorch).abs().max()
+    print(f'* {fwdok} check_gather_forward_equal_with_pytorch_double: max_abs_err {max_abs_err:.2e}')
+
+    grads_pytorch = torch.autograd.grad((output_pytorch * grad_output).sum(), inputs)
+    grads_gather = torch.autograd.grad((output_gather * grad_output).sum(), inputs)
+    for name, grad_pytorch, grad_gather in zip(('value', 'sampling_loc', 'attn_weight'), grads_pytorch, grads_gather):
+        bwdok = torch.allclose(grad_gather, grad_pytorch)
+        max_abs_err = (grad_gather - grad_pytorch).abs().max()
+        print(f'* {bwdok} check_gather_backward_equal_with_pytorch_double(grad_{name}): max_abs_err {max_abs_err:.2e}')
+
+    func = lambda v, loc, attn: ms_deform_attn_core_gather(v, shapes.cpu(), level_start_index.cpu(), loc, attn)
+    gradok = gradcheck(func, inputs)
+    print(f'* {gradok} check_gather_gradient_numerical')
+
+
+def benchmark_gather_with_pytorch(num_iters=3):
+    # MOTR shapes: 800 x 1536 input, 4 levels, 8 heads of 32 channels and 4 points.
+    spatial_shapes = torch.as_tensor([(100, 192), (50, 96), (25, 48), (13, 24)], dtype=torch.long)
+    start_index = torch.cat((spatial_shapes.new_zeros((1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
+    num_tokens = int(spatial_shapes.prod(1).sum())
+    n_heads, head_dim, n_levels, n_points = 8, 32, 4, 4
+
+    def run(fn, num_queries, backward):
+        value = torch.rand(1, num_tokens, n_heads, head_dim)
+        sampling_locations = torch.rand(1, num_queries, n_heads, n_levels, n_points, 2)
+        attention_weights = torch.rand(1, num_queries, n_heads, n_levels, n_points)
+        for x in (value, sampling_locations, attention_weights):
+            x.requires_grad = backward
+        ts = []
+        for _ in range(num_iters):
+            t_ = time.perf_counter()
+            with torch.set_grad_enabled(backward):
+                output = fn(value, spatial_shapes, start_index, sampling_locations, attention_weights)
+                if backward:
+                    output.sum().backward()
+            ts.append(time.perf_counter() - t_)
+        return min(ts) * 1000
+
+    pytorch = lambda value, shapes_, start_, loc, attn: ms_deform_attn_core_pytorch(value, shapes_, loc, attn)
+    for name, num_queries, backward in [('decoder forward', 400, False),
+                                        ('decoder forward+backward', 400, True),
+                                        ('encoder forward', num_tokens, False)]:
+        t_pytorch = run(pytorch, num_queries, backward)
+        t_gather = run(ms_deform_attn_core_gather, num_queries, backward)
+        print(f'* {name} ({num_queries} queries, {num_tokens} tokens, {torch.get_num_threads()} threads): '
+              f'pytorch {t_pytorch:.1f} ms gather {t_gather:.1f} ms')
+
+
 if __name__ == '__main__':
-    check_forward_equal_with_pytorch_double()
-    check_forward_equal_with_pytorch_float()
+    if with_cuda:
+        check_forward_equal_with_pytorch_double()
+        check_forward_equal_with_pytorch_float()
+
+        for channels in [30, 32, 64, 71, 1025, 2048, 3096]:
+            check_gradient_numerical(channels, True, True, True)
 
-    for channels in [30, 32, 64, 71, 1025, 2048, 3096]:
-        check_gradient_numerical(channels, True, True, True)
+    check_gather_equal_with_pytorch_double()
+    benchmark_gather_with_pytorch()
 
 
 
@@ -17,6 +17,7 @@ import torch
 from torch import nn
 
 from util.misc import NestedTensor
+from util.cache import ShapeCache, mask_key
 
 
 class PositionEmbeddingSine(nn.Module):
@@ -34,11 +35,15 @@ class PositionEmbeddingSine(nn.Module):
         if scale is None:
             scale = 2 * math.pi
         self.scale = scale
+        self._cache = ShapeCache()
 
     def forward(self, tensor_list: NestedTensor):
-        x = tensor_list.tensors
         mask = tensor_list.mask
         assert mask is not None
+        # the encoding only depends on the padding mask.
+        return self._cache(mask_key(mask), lambda: self._embed(mask), enabled=not self.training)
+
+    def _embed(self, mask):
         not_mask = ~mask
         y_embed = not_mask.cumsum(1, dtype=torch.float32)
         x_embed = not_mask.cumsum(2, dtype=torch.float32)
@@ -47,7 +52,7 @@ class PositionEmbeddingSine(nn.Module):
             y_embed = (y_embed - 0.5) / (y_embed[:, -1:, :] + eps) * self.scale
             x_embed = (x_embed - 0.5) / (x_embed[:, :, -1:] + eps) * self.scale
 
-        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
+        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=mask.device)
         dim_t = self.temperature ** (2 * (dim_t // 2) / self.num_pos_feats)
 
         pos_x = x_embed[:, :, :, None] / dim_t
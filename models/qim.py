@@ -145,7 +145,8 @@ class QueryInteractionModule(QueryInteractionBase):
         return active_track_instances
 
     def _update_track_embedding(self, track_instances: Instances) -> Instances:
-        if len(track_instances) == 0:
+        # a traced step keeps the general path, it also handles no active track.
+        if not torch.jit.is_tracing() and len(track_instances) == 0:
             return track_instances
         dim = track_instances.query_pos.shape[1]
         out_embed = track_instances.output_embedding
@@ -176,7 +177,16 @@ class QueryInteractionModule(QueryInteractionBase):
         track_instances.ref_pts = inverse_sigmoid(track_instances.pred_boxes[:, :2].detach().clone())
         return track_instances
 
+    def _forward_slots(self, track_instances: Instances, track_slots) -> Instances:
+        # the same as forward at inference, with the active tracks scattered into their slots.
+        rows = torch.nonzero(track_instances.obj_idxes >= 0)[:, 0]
+        active_track_instances = self._update_track_embedding(track_instances[rows])
+        track_slots.update(rows, active_track_instances)
+        return track_slots.packed()
+
     def forward(self, data) -> Instances:
+        if data.get('track_slots') is not None:
+            return self._forward_slots(data['track_instances'], data['track_slots'])
         active_track_instances = self._select_active_tracks(data)
         active_track_instances = self._update_track_embedding(active_track_instances)
         init_track_instances: Instances = data['init_track_instances']
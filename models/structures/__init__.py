@@ -4,5 +4,6 @@
 # ------------------------------------------------------------------------
 from .boxes import Boxes, BoxMode, pairwise_iou, pairwise_ioa, matched_boxlist_iou
 from .instances import Instances
+from .track_slots import TrackSlots
 
 __all__ = [k for k in globals().keys() if not k.startswith("_")]
\ No newline at end of file
@@ -0,0 +1,107 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+from typing import List
+import torch
+
+from .instances import Instances
+
+
+class TrackSlots:
+    """
+    Fixed-capacity store of the track state of a sequence during inference.
+
+    The first slots hold the detect queries and are never reassigned, the following ones hold one
+    track each and are reused once their track is dropped, so that a frame only scatters the active
+    tracks into their slots instead of building new track instances. The store grows when more tracks
+    are alive than it has slots.
+
+    `packed()` gathers the detect queries followed by the active tracks into preallocated buffers,
+    in the order of Instances.cat([detect queries, active tracks]). The returned Instances alias these
+    buffers and are overwritten by the next `packed()`. State fields that are not tensors (e.g. the
+    memory bank) are kept for the active tracks only and concatenated with the ones of the detect queries.
+    """
+    def __init__(self, template: Instances, state_fields: List[str], output_fields: List[str], max_tracks: int):
+        """
+        Args:
+            template: the detect queries, as generated for an empty frame.
+            state_fields: fields carried to the next frame.
+            output_fields: fields of the previous frame read by the post-processing, zero for the detect queries.
+            max_tracks: initial number of track slots.
+        """
+        self.num_detect = len(template)
+        self.state_fields = [k for k in state_fields if isinstance(template.get(k), torch.Tensor)]
+        self.output_fields = list(output_fields)
+        self._detect_values = {k: template.get(k) for k in state_fields if k not in self.state_fields}
+        self._track_values = {k: v[:0] for k, v in self._detect_values.items()}
+        capacity = self.num_detect + max(max_tracks, 1)
+        self._slots = {k: self._alloc(template.get(k), capacity) for k in self.state_fields}
+        self._packed = {k: self._alloc(template.get(k), capacity) for k in self.state_fields + self.output_fields}
+
+        device = template.obj_idxes.device
+        self._detect_index = torch.arange(self.num_detect, device=device)
+        # slot of every packed row, and whether a slot is in use.
+        self.index = self._detect_index
+        self.active = torch.zeros((capacity, ), dtype=torch.bool, device=device)
+        self.active[:self.num_detect] = True
+
+    def _alloc(self, value, capacity):
+        buf = value.new_zeros((capacity, ) + value.shape[1:])
+        buf[:self.num_detect] = value
+        return buf
+
+    @property
+    def capacity(self) -> int:
+        return len(self.active)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _grow(self, num_slots):
+        def grow(buf):
+            return torch.cat([buf, buf.new_zeros((num_slots, ) + buf.shape[1:])])
+        self._slots = {k: grow(v) for k, v in self._slots.items()}
+        self._packed = {k: grow(v) for k, v in self._packed.items()}
+        self.active = grow(self.active)
+
+    def update(self, rows: torch.Tensor, track_instances: Instances):
+        """
+        Stores the tracks alive after this frame.
+        Args:
+            rows: increasing rows of the tracks in the last packed instances. Rows of detect queries are new tracks.
+            track_instances: the updated tracks, one per row.
+        """
+        slots = self.index[rows]
+        num_born = int((rows < self.num_detect).sum())
+
+        # free the slots of the dropped tracks and take free slots for the new ones.
+        self.active[self.num_detect:] = False
+        self.active[slots[num_born:]] = True
+        free = torch.nonzero(~self.active)[:, 0]
+        if len(free) < num_born:
+            self._grow(max(num_born - len(free), self.capacity - self.num_detect))
+            free = torch.nonzero(~self.active)[:, 0]
+        slots[:num_born] = free[:num_born]
+        self.active[slots] = True
+
+        for k in self.state_fields:
+            self._slots[k].index_copy_(0, slots, track_instances.get(k))
+        num_rows = self.num_detect + len(slots)
+        for k in self.output_fields:
+            self._packed[k][self.num_detect:num_rows] = track_instances.get(k)
+        for k in self._track_values:
+            self._track_values[k] = track_instances.get(k)
+        self.index = torch.cat([self._detect_index, slots])
+
+    def packed(self) -> Instances:
+        num_rows = len(self.index)
+        instances = Instances((1, 1))
+        for k in self.state_fields:
+            instances.set(k, torch.index_select(self._slots[k], 0, self.index, out=self._packed[k][:num_rows]))
+        for k in self.output_fields:
+            instances.set(k, self._packed[k][:num_rows])
+        for k, v in self._detect_values.items():
+            instances.set(k, type(v).cat([v, self._track_values[k]]))
+        instances._slots = self
+        return instances
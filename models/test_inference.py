@@ -0,0 +1,90 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+"""
+Checks that the inference fast paths of MOTR write the same tracking results as the paths used in training:
+the output heads on the last decoder layer only and the cached detect-query template.
+Run from the root of the repository with the arguments of main.py, e.g.
+    python -m models.test_inference --resume motr_final.pth --meta_arch motr --with_box_refine ...
+"""
+import argparse
+import functools
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from main import get_args_parser as get_main_args_parser
+from models import build_model
+from models.motr import MOTR
+from util.tool import load_model
+from inference import InferenceEngine, ImagePreprocessor, MOTResultWriter
+
+
+def get_check_arg_parser():
+    parser = argparse.ArgumentParser('Check the inference fast paths of MOTR.')
+    parser.add_argument('--num_frames', type=int, default=6)
+    parser.add_argument('--frame_size', type=int, nargs=2, default=(120, 200), metavar=('H', 'W'),
+                        help='size of the synthetic frames, a textured background shifted by a few pixels per frame')
+    parser.add_argument('--input_height', type=int, default=96, help='frames are resized like ImagePreprocessor does')
+    parser.add_argument('--input_width', type=int, default=160)
+    parser.add_argument('--prob_threshold', type=float, default=0.7)
+    return parser
+
+
+def synthetic_frames(num_frames, height, width):
+    rng = np.random.RandomState(0)
+    base = (rng.rand(height, width, 3) * 255).astype(np.uint8)
+    return [np.roll(base, i * 3, axis=1) for i in range(num_frames)]
+
+
+def use_training_paths(model):
+    """All the decoder layers go through the output heads and the detect queries are rebuilt every frame."""
+    model._decode_single_image = functools.partial(MOTR._decode_single_image, model, last_layer_only=False)
+    model._generate_empty_tracks = model._build_empty_tracks
+
+
+def use_inference_paths(model):
+    for name in ('_decode_single_image', '_generate_empty_tracks'):
+        model.__dict__.pop(name, None)
+
+
+def track(model, frames, preprocessor, path, prob_threshold):
+    model.clear()
+    engine = InferenceEngine(model, num_decode_workers=0, num_output_workers=0, preprocessor=preprocessor)
+    engine.run(frames, [MOTResultWriter(path)], prob_threshold=prob_threshold, area_threshold=0)
+    # nothing is written without tracks.
+    if not os.path.exists(path):
+        return ''
+    with open(path) as f:
+        return f.read()
+
+
+@torch.no_grad()
+def check_fast_paths_equal_with_training_paths():
+    args, _ = get_check_arg_parser().parse_known_args()
+    main_args = get_main_args_parser().parse_args(_)
+    model, _, _ = build_model(main_args)
+    if main_args.resume:
+        model = load_model(model, main_args.resume)
+    model.eval()
+    model.to(torch.device(main_args.device))
+
+    frames = synthetic_frames(args.num_frames, *args.frame_size)
+    preprocessor = ImagePreprocessor(args.input_height, args.input_width)
+    with tempfile.TemporaryDirectory() as out_dir:
+        use_inference_paths(model)
+        fast = track(model, frames, preprocessor, os.path.join(out_dir, 'fast.txt'), args.prob_threshold)
+        use_training_paths(model)
+        full = track(model, frames, preprocessor, os.path.join(out_dir, 'full.txt'), args.prob_threshold)
+        use_inference_paths(model)
+    ok = fast == full
+    print(f'* {ok} check_fast_paths_equal_with_training_paths: {len(full.splitlines())} result lines '
+          f'over {args.num_frames} frames')
+    return ok
+
+
+if __name__ == '__main__':
+    assert check_fast_paths_equal_with_training_paths()
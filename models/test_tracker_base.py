@@ -0,0 +1,62 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+"""
+Checks that the masked RuntimeTrackerBase.update assigns the same ids and disappear times as the per-track
+loop it replaced. Run from the root of the repository:
+    python -m models.test_tracker_base
+"""
+import torch
+
+from models.motr import RuntimeTrackerBase
+from models.structures import Instances
+
+
+torch.manual_seed(3)
+
+
+def update_with_loop(tracker: RuntimeTrackerBase, track_instances: Instances):
+    """The per-track loop of the original RuntimeTrackerBase.update."""
+    track_instances.disappear_time[track_instances.scores >= tracker.score_thresh] = 0
+    for i in range(len(track_instances)):
+        if track_instances.obj_idxes[i] == -1 and track_instances.scores[i] >= tracker.score_thresh:
+            track_instances.obj_idxes[i] = tracker.max_obj_id
+            tracker.max_obj_id += 1
+        elif track_instances.obj_idxes[i] >= 0 and track_instances.scores[i] < tracker.filter_score_thresh:
+            track_instances.disappear_time[i] += 1
+            if track_instances.disappear_time[i] >= tracker.miss_tolerance:
+                track_instances.obj_idxes[i] = -1
+
+
+def random_tracks(num_tracks, max_obj_id):
+    track_instances = Instances((1, 1))
+    track_instances.scores = torch.rand(num_tracks)
+    track_instances.obj_idxes = torch.randint(-1, max_obj_id, (num_tracks, ))
+    track_instances.disappear_time = torch.randint(0, 6, (num_tracks, ))
+    return track_instances
+
+
+def check_update_equal_with_loop(num_sequences=50, num_frames=20, num_tracks=64):
+    ok = True
+    for _ in range(num_sequences):
+        loop_tracker, tracker = RuntimeTrackerBase(), RuntimeTrackerBase()
+        loop_tracker.max_obj_id = tracker.max_obj_id = int(torch.randint(0, 20, ()))
+        loop_tracks = random_tracks(num_tracks, loop_tracker.max_obj_id)
+        tracks = Instances((1, 1), **{k: v.clone() for k, v in loop_tracks.get_fields().items()})
+        for _ in range(num_frames):
+            update_with_loop(loop_tracker, loop_tracks)
+            tracker.update(tracks)
+            ok &= bool((loop_tracks.obj_idxes == tracks.obj_idxes).all())
+            ok &= bool((loop_tracks.disappear_time == tracks.disappear_time).all())
+            ok &= int(loop_tracker.max_obj_id) == int(tracker.max_obj_id)
+            # the next frame scores the same tracks again.
+            scores = torch.rand(num_tracks)
+            loop_tracks.scores = scores
+            tracks.scores = scores.clone()
+    print(f'* {ok} check_update_equal_with_loop: {num_sequences} sequences of {num_frames} frames')
+    return ok
+
+
+if __name__ == '__main__':
+    assert check_update_equal_with_loop()
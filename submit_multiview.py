@@ -0,0 +1,86 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+# Modified from Deformable DETR (https://github.com/fundamentalvision/Deformable-DETR)
+# Copyright (c) 2020 SenseTime. All Rights Reserved.
+# ------------------------------------------------------------------------
+# Modified from DETR (https://github.com/facebookresearch/detr)
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+# ------------------------------------------------------------------------
+
+"""
+Submission for the multi-drone dataset. Both views of a sequence are tracked together:
+their frames are decoded in parallel and share one batched forward, while each view keeps
+its own track state. Results are written per view to <output_dir>/<exp_name>/<view>/<vid>.txt.
+"""
+from __future__ import print_function
+
+import os
+import argparse
+import torch
+from pathlib import Path
+from main import get_args_parser
+from inference import MultiSequenceEngine, SequenceTask, list_sequence_images, MOTResultWriter, configure_threads, load_inference_model
+
+VIEWS = ('1', '2')
+
+
+def list_view_pairs(split_dir):
+    """Lists the sequences of a split as pairs of (view 1, view 2) folder names."""
+    pairs = []
+    for vid in sorted(os.listdir(os.path.join(split_dir, VIEWS[0]))):
+        vid_2 = vid.replace('-1', '-2')
+        if not os.path.isdir(os.path.join(split_dir, VIEWS[1], vid_2)):
+            print(f'skip {vid}: no second view')
+            continue
+        pairs.append((vid, vid_2))
+    return pairs
+
+
+class MultiViewDetector(object):
+    def __init__(self, args, model=None, batch_pairs=1):
+        self.args = args
+        self.detr = model
+        self.split_dir = args.data_txt_path_test if args.data_txt_path_test else os.path.join(args.mot_path, 'test')
+        # the views of a pair are adjacent in the task list and form a group, so they always share a batch.
+        self.engine = MultiSequenceEngine(model,
+                                          batch_size=len(VIEWS) * batch_pairs,
+                                          group_size=len(VIEWS),
+                                          num_decode_workers=args.num_decode_workers,
+                                          num_output_workers=args.num_output_workers,
+                                          queue_size=args.queue_size)
+
+        self.predict_path = os.path.join(self.args.output_dir, args.exp_name)
+        for view in VIEWS:
+            os.makedirs(os.path.join(self.predict_path, view), exist_ok=True)
+
+    def sequence_tasks(self, pairs):
+        tasks = []
+        for vids in pairs:
+            for view, vid in zip(VIEWS, vids):
+                img_list = list_sequence_images(os.path.join(self.split_dir, view, vid))
+                sinks = [MOTResultWriter(os.path.join(self.predict_path, view, f'{vid}.txt'), save_npz=self.args.save_npz)]
+                tasks.append(SequenceTask(os.path.join(view, vid), img_list, sinks))
+        return tasks
+
+    def detect(self, prob_threshold=0.7, area_threshold=100):
+        pairs = list_view_pairs(self.split_dir)
+        all_stats = self.engine.run_sequences(self.sequence_tasks(pairs), prob_threshold, area_threshold)
+        for name, stats in all_stats.items():
+            print("{}: totally {} dts {} occlusion dts".format(name, stats['total_dts'], stats['total_occlusion_dts']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('DETR training and evaluation script', parents=[get_args_parser()])
+    args = parser.parse_args()
+    if args.output_dir:
+        Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    configure_threads(args)
+
+    # load model and weights
+    detr = load_inference_model(args)
+
+    det = MultiViewDetector(args, model=detr, batch_pairs=max(args.batch_sequences, 1))
+    det.detect()
@@ -0,0 +1,74 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2021 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+
+"""
+Memoization of the tensors that only depend on the input geometry (frame size, padding, device),
+e.g. the padding masks of the feature levels, the position encodings and the encoder reference points.
+All the frames of a video share them.
+"""
+from collections import OrderedDict
+
+import torch
+
+
+def image_sizes_key(mask, image_sizes):
+    """Key of a padding mask from the (h, w) of its images, known on the host: no device sync."""
+    return (tuple(mask.shape), str(mask.device), mask.dtype) + tuple(v for size in image_sizes for v in size)
+
+
+def set_mask_key(mask, key):
+    """Keys a mask whose key is known without reading it, e.g. one derived from the mask of the input."""
+    mask._shape_cache_key = key
+    return mask
+
+
+def mask_key(mask):
+    """
+    Hashable key of a [B, H, W] padding mask: its shape, device, dtype and the valid (h, w) of every image.
+    Masks built by nested_tensor_from_tensor_list are keyed from the image sizes, others are reduced on
+    their device once, assuming the padding at the bottom and the right. The key is kept on the tensor.
+    """
+    if torch.jit.is_tracing():
+        return None
+    key = getattr(mask, '_shape_cache_key', None)
+    if key is None:
+        valid_h = (~mask[:, :, 0]).sum(1)
+        valid_w = (~mask[:, 0, :]).sum(1)
+        key = image_sizes_key(mask, torch.stack([valid_h, valid_w], 1).tolist())
+        mask._shape_cache_key = key
+    return key
+
+
+class ShapeCache(object):
+    """
+    Bounded LRU cache of deterministic functions of the input geometry.
+    Cached tensors are shared between calls and must not be modified in place.
+    The modules only enable it at inference, `enabled=not self.training`.
+    """
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, key, fn, enabled=True):
+        # traced graphs have to compute the values from their inputs.
+        if not enabled or self.maxsize <= 0 or torch.jit.is_tracing():
+            return fn()
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        value = fn()
+        self._entries[key] = value
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        self.misses += 1
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -27,6 +27,8 @@ import torch.nn as nn
 import torch.distributed as dist
 from torch import Tensor
 
+from util.cache import image_sizes_key, set_mask_key
+
 # needed due to empty tensor bug in pytorch and torchvision 0.5
 import torchvision
 if float(torchvision.__version__[:3]) < 0.5:
@@ -350,6 +352,9 @@ def nested_tensor_from_tensor_list(tensor_list: List[Tensor], size_divisibility:
         for img, pad_img, m in zip(tensor_list, tensor, mask):
             pad_img[: img.shape[0], : img.shape[1], : img.shape[2]].copy_(img)
             m[: img.shape[1], :img.shape[2]] = False
+        if not torch.jit.is_tracing():
+            # the shape caches key the mask from the image sizes instead of reading it back.
+            set_mask_key(mask, image_sizes_key(mask, [img.shape[1:] for img in tensor_list]))
     else:
         raise ValueError('not supported')
     return NestedTensor(tensor, mask)